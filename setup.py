@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 """Setup to install TeamPasswordManager API Python Module."""
-from distutils.core import setup
+from setuptools import setup
 setup(name='tpm',
       version='4.2',
       py_modules=['tpm'],
       install_requires=['requests<=2.26.0', 'future', 'urllib3'],
+      extras_require={'async': ['aiohttp'],
+                      'fast-json': ['orjson'],
+                      'numpy': ['numpy']},
       description='Provides functions to work with TeamPasswordManager API.',
       url='https://github.com/peshay/tpm',
       author='Andreas Hubert',
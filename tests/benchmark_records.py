@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+"""Compare the memory of a password inventory as dicts and as records.
+
+    python tests/benchmark_records.py [number of passwords]
+"""
+import tpm
+import json
+import sys
+import tracemalloc
+
+# Taken from resources/passwords.json and resources/passwords/14.json
+ITEM = {"id": 0, "name": "Wordpress admin", "username": "admin_sg",
+        "email": "", "tags": "wordpress", "archived": False, "locked": False,
+        "favorite": True, "access_info": "http://www.fictionalgadgetsite.com/wp-admin",
+        "project": {"id": 18, "name": "www.fictionalgadgetsite.com"},
+        "num_files": 0, "expiry_date": None, "expiry_status": 0,
+        "notes_snippet": "", "external_sharing": False,
+        "updated_on": "2016-09-07 04:41:45"}
+PAGE = 20
+PROJECTS = 50
+
+
+def pages(count):
+    """Yield count passwords decoded page by page, like they are received."""
+    for start in range(0, count, PAGE):
+        items = []
+        for ID in range(start, min(start + PAGE, count)):
+            project = ID % PROJECTS
+            items.append(dict(ITEM, id=ID, name='{} {}'.format(ITEM['name'], ID),
+                              project={'id': project, 'name': 'Project {}'.format(project)}))
+        yield json.loads(json.dumps(items))
+
+
+def inventory(count, record=None, dedupe=False):
+    """Return the inventory as a list of dicts or records."""
+    interner = tpm.Interner() if dedupe else None
+    items = []
+    for page in pages(count):
+        for item in page:
+            if interner is not None:
+                item = interner(item)
+            items.append(item if record is None else record(item))
+    return items
+
+
+def measure(count, **kwargs):
+    """Return the bytes still allocated by the inventory."""
+    tracemalloc.start()
+    items = inventory(count, **kwargs)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del items
+    return size
+
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+dicts = measure(count)
+print('{} passwords'.format(count))
+for title, kwargs in (('dicts', {}),
+                      ('dicts, dedupe', {'dedupe': True}),
+                      ('records', {'record': tpm.Password}),
+                      ('records, dedupe', {'record': tpm.Password, 'dedupe': True})):
+    size = dicts if not kwargs else measure(count, **kwargs)
+    print('{:16} {:8.1f} MB ({:.0%} less)'.format(
+        title + ':', size / 2.0 ** 20, 1 - float(size) / dicts))
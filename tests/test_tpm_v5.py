@@ -9,6 +9,14 @@ import hmac
 import hashlib
 import time
 import random
+import io
+import asyncio
+import inspect
+import threading
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+from aioresponses import aioresponses
 
 log = logging.getLogger(__name__)
 
@@ -1273,4 +1281,1832 @@ class ClientFilesTestCase(unittest.TestCase):
         with requests_mock.Mocker() as m:
             m.delete(request_url, status_code=204)
             response = self.client.delete_file('4')
-        self.assertEqual(response, None)
\ No newline at end of file
+        self.assertEqual(response, None)
+
+class SessionTestCases(unittest.TestCase):
+    """Test cases for the pooled connection handling."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+
+    def test_session_is_reused(self):
+        """All requests share one pooled session."""
+        request_url = api_url + 'version.json'
+        with requests_mock.Mocker() as m:
+            m.get(request_url, json={})
+            self.client.get_version()
+            session = self.client.session
+            self.client.get_version()
+        self.assertIs(session, self.client.session)
+
+    def test_pool_settings(self):
+        """Pool size is passed to the connection adapter."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', pool_connections=2, pool_maxsize=32)
+        adapter = client.get_session().get_adapter('https://tpm.example.com')
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 32)
+
+    def test_no_keep_alive(self):
+        """Disabling keep-alive closes the connection after each request."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', keep_alive=False)
+        request_url = api_url + 'version.json'
+        with requests_mock.Mocker() as m:
+            m.get(request_url, json={})
+            client.get_version()
+            history = m.request_history
+        self.assertEqual(history[0].headers.get('Connection'), 'close')
+
+    def test_max_idle(self):
+        """An idle session is replaced after max_idle seconds."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', max_idle=60)
+        session = client.get_session()
+        client.last_used -= 120
+        self.assertIsNot(session, client.get_session())
+
+    def test_context_manager(self):
+        """Leaving the context closes the session."""
+        request_url = api_url + 'version.json'
+        with requests_mock.Mocker() as m:
+            m.get(request_url, json={})
+            with tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS') as client:
+                client.get_version()
+                self.assertIsNotNone(client.session)
+        self.assertIsNone(client.session)
+
+def run(coroutine):
+    """Run a coroutine in a fresh event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+class AsyncClientTestCases(unittest.TestCase):
+    """Test cases for the asyncio client."""
+    def setUp(self):
+        self.client = tpm.AsyncTpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+
+    def tearDown(self):
+        run(self.client.close())
+
+    def test_all_functions_are_coroutines(self):
+        """Every API function of TpmApiv5 has an asyncio counterpart."""
+        for name in dir(tpm.TpmApiv5):
+            function = getattr(tpm.TpmApiv5, name)
+            if name.startswith('_') or not inspect.isfunction(function) or\
+                    name in tpm.AsyncTpmApi.helpers or\
+                    name in tpm.AsyncTpmApi.sync_only:
+                continue
+            async_function = getattr(tpm.AsyncTpmApiv5, name, None)
+            if name in ('get_collection', 'get_pages'):
+                self.assertTrue(inspect.isasyncgenfunction(async_function), name)
+            else:
+                self.assertTrue(inspect.iscoroutinefunction(async_function), name)
+
+    def test_sync_only_helpers_are_rejected(self):
+        """Helpers relying on threads raise TypeError when called."""
+        for name in tpm.AsyncTpmApi.sync_only:
+            with self.assertRaises(TypeError):
+                getattr(self.client, name)(['1'])
+        with self.assertRaises(TypeError):
+            with self.client.deadline(1):
+                pass
+
+    def test_unsupported_options_are_rejected(self):
+        """Options the asyncio client can not honour raise ConfigError."""
+        for key in tpm.AsyncTpmApi.unsupported:
+            with self.assertRaises(tpm.TpmApi.ConfigError):
+                tpm.AsyncTpmApiv5('https://tpm.example.com', username='USER',
+                                  password='PASS', **{key: 2})
+
+    def test_sync_consumers_are_rejected(self):
+        """Mirror, SearchIndex and the like need a synchronous client."""
+        for consumer in (tpm.Mirror, tpm.SearchIndex, tpm.ProjectTree,
+                         tpm.AccessMatrix, tpm.Columns):
+            with self.assertRaises(tpm.TpmApi.ConfigError):
+                consumer(self.client)
+
+    def test_versions_share_functions(self):
+        """The API functions of a version are coroutines of that version."""
+        client = tpm.AsyncTpmApiv4('https://tpm.example.com', username='USER', password='PASS')
+        self.assertTrue(inspect.iscoroutinefunction(client.list_subprojects))
+        self.assertFalse(hasattr(client, 'list_project_files'))
+        with aioresponses() as m:
+            m.put(api_url.replace('v5', 'v4') + 'users/1/convert_to_ldap.json', status=204, body=b'')
+            run(client.convert_user_to_ldap('1', 'cn=user'))
+            request = list(m.requests.values())[0][0]
+        run(client.close())
+        self.assertEqual(json.loads(request.kwargs['data']), {'login_dn': 'cn=user'})
+
+    def test_up_to_date(self):
+        """Functions building on other API functions await them."""
+        with aioresponses() as m:
+            m.get(api_url + 'version/check_latest.json',
+                  payload={'version': '12.0', 'latest_version': '12.0'})
+            self.assertTrue(run(self.client.up_to_date()))
+
+    def test_delete_is_sent(self):
+        """Functions without a result still make their request."""
+        with aioresponses() as m:
+            m.delete(api_url + 'passwords/42.json', status=204, body=b'')
+            response = run(self.client.delete_password('42'))
+            self.assertEqual(len(m.requests), 1)
+        self.assertEqual(response, None)
+
+    def test_circuit_breaker(self):
+        """An open circuit breaker fails requests fast."""
+        breaker = tpm.CircuitBreaker(failure_rate=0.5, window=2, minimum=1)
+        client = tpm.AsyncTpmApiv5('https://tpm.example.com', username='USER',
+                                   password='PASS', circuit_breaker=breaker)
+        with aioresponses() as m:
+            m.get(api_url + 'passwords/1.json', status=500, repeat=True,
+                  payload={'error': True, 'message': 'Internal error'})
+            with self.assertRaises(tpm.TPMException):
+                run(client.show_password('1'))
+            with self.assertRaises(tpm.CircuitOpenError):
+                run(client.show_password('1'))
+        run(client.close())
+
+    def test_paging(self):
+        """get_collection follows the next links."""
+        with aioresponses() as m:
+            m.get(api_url + 'passwords.json', payload=[{'id': 1}, {'id': 2}],
+                  headers={'Link': '<{}passwords/page/2.json>; rel="next"'.format(api_url)})
+            m.get(api_url + 'passwords/page/2.json', payload=[{'id': 3}])
+            response = run(self.client.list_passwords())
+        self.assertEqual([1, 2, 3], [item['id'] for item in response])
+
+    def test_create_returns_id(self):
+        """Create functions return the new ID."""
+        with aioresponses() as m:
+            m.post(api_url + 'passwords.json', payload={'id': 42})
+            response = run(self.client.create_password({'name': 'new'}))
+        self.assertEqual(response, 42)
+
+    def test_update_returns_none(self):
+        """Update functions return nothing."""
+        with aioresponses() as m:
+            m.put(api_url + 'passwords/42.json', status=204, body=b'')
+            response = run(self.client.update_password('42', {'name': 'new'}))
+        self.assertEqual(response, None)
+
+    def test_key_authentication(self):
+        """HMAC headers are calculated like in the synchronous client."""
+        private_key = 'private_secret'
+        client = tpm.AsyncTpmApiv5('https://tpm.example.com', private_key=private_key, public_key='public_secret', unlock_reason='because')
+        data = {'name': 'new'}
+        with aioresponses() as m:
+            m.post(api_url + 'passwords.json', payload={'id': 42})
+            run(client.create_password(data))
+            request = list(m.requests.values())[0][0]
+        run(client.close())
+        headers = request.kwargs['headers']
+        body = request.kwargs['data']
+        self.assertEqual(json.loads(body), data)
+        unhashed = ('api/v5/passwords.json' + headers['X-Request-Timestamp']).encode('utf-8') + body
+        hashed = hmac.new(str.encode(private_key), msg=unhashed,
+                          digestmod=hashlib.sha256).hexdigest()
+        self.assertEqual(headers['X-Request-Hash'], hashed)
+        self.assertEqual(headers['X-Unlock-Reason'], 'because')
+
+    def test_exception_on_404(self):
+        """Exception if 404 not found."""
+        with aioresponses() as m:
+            m.get(api_url + 'passwords/1.json', status=404, body='not found')
+            with self.assertRaises(tpm.TPMException):
+                run(self.client.show_password('1'))
+
+    def test_connection_exception(self):
+        """Exception if connection fails."""
+        with aioresponses() as m:
+            with self.assertRaises(tpm.TPMException):
+                run(self.client.show_password('1'))
+
+class PrefetchTestCases(unittest.TestCase):
+    """Test cases for prefetching collection pages."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', prefetch=2)
+
+    def register_pages(self, m, pages):
+        """Register a collection linked by next headers."""
+        for number in range(1, pages + 1):
+            url = api_url + 'passwords/page/{}.json'.format(number)
+            if number == 1:
+                url = api_url + 'passwords.json'
+            headers = {}
+            if number < pages:
+                headers = {'link': '<{}passwords/page/{}.json>; rel="next"'.format(api_url, number + 1)}
+            m.get(url, json=[{'id': number * 10 + i} for i in range(3)], headers=headers)
+
+    def test_prefetch_keeps_order(self):
+        """Prefetched items come in page order."""
+        with requests_mock.Mocker() as m:
+            self.register_pages(m, 6)
+            response = self.client.list_passwords()
+        self.assertEqual([item['id'] for item in response],
+                         [page * 10 + i for page in range(1, 7) for i in range(3)])
+
+    def test_prefetch_early_termination(self):
+        """Stopping early does not request the whole collection."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+        with requests_mock.Mocker() as m:
+            self.register_pages(m, 10)
+            items = client.get_collection('passwords.json', prefetch=1)
+            first = next(items)
+            time.sleep(0.2)
+            items.close()
+            calls = m.call_count
+        self.assertEqual(first['id'], 10)
+        self.assertLessEqual(calls, 3)
+
+    def test_prefetch_exception(self):
+        """Errors of prefetched pages are raised in the consumer."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', json=[{'id': 1}],
+                  headers={'link': '<{}passwords/page/2.json>; rel="next"'.format(api_url)})
+            m.get(api_url + 'passwords/page/2.json', text='not found', status_code=404)
+            items = self.client.get_collection('passwords.json')
+            self.assertEqual(next(items)['id'], 1)
+            with self.assertRaises(tpm.TPMException):
+                next(items)
+
+class ParallelPagesTestCases(unittest.TestCase):
+    """Test cases for count based concurrent paging."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', page_workers=4)
+
+    def test_parallel_pages_in_order(self):
+        """Pages are requested by number and returned in order."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/count.json', json={'num_items': 25, 'num_pages': 5, 'num_items_per_page': 5})
+            for page in range(1, 6):
+                m.get(api_url + 'passwords/page/{}.json'.format(page),
+                      json=[{'id': page * 10 + i} for i in range(5)])
+            response = self.client.list_passwords()
+        self.assertEqual([item['id'] for item in response],
+                         [page * 10 + i for page in range(1, 6) for i in range(5)])
+
+    def test_parallel_pages_deduplicated(self):
+        """Items shifted to the next page are returned once."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/count.json', json={'num_items': 4, 'num_pages': 2, 'num_items_per_page': 2})
+            m.get(api_url + 'passwords/page/1.json', json=[{'id': 1}, {'id': 2}])
+            m.get(api_url + 'passwords/page/2.json', json=[{'id': 2}, {'id': 3}],
+                  headers={'link': '<{}passwords/page/3.json>; rel="next"'.format(api_url)})
+            m.get(api_url + 'passwords/page/3.json', json=[{'id': 4}])
+            response = self.client.list_passwords()
+        self.assertEqual([item['id'] for item in response], [1, 2, 3, 4])
+
+    def test_parallel_pages_without_count(self):
+        """Collections without count are paged by next links."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/count.json', text='not found', status_code=404)
+            m.get(api_url + 'passwords.json', json=[{'id': 1}],
+                  headers={'link': '<{}passwords/page/2.json>; rel="next"'.format(api_url)})
+            m.get(api_url + 'passwords/page/2.json', json=[{'id': 2}])
+            response = self.client.list_passwords()
+        self.assertEqual([item['id'] for item in response], [1, 2])
+
+class ThreadSafetyTestCases(unittest.TestCase):
+    """Test cases for sharing one client between threads."""
+    def setUp(self):
+        self.private_key = 'private_secret'
+        self.client = tpm.TpmApiv5('https://tpm.example.com', private_key=self.private_key, public_key='public_secret')
+
+    def test_concurrent_signatures(self):
+        """Every request is signed with its own path."""
+        with requests_mock.Mocker() as m:
+            for ID in range(50):
+                m.get(api_url + 'passwords/{}.json'.format(ID), json={'id': ID})
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(self.client.show_password, range(50)))
+            history = m.request_history
+        self.assertEqual([result['id'] for result in results], list(range(50)))
+        for request in history:
+            unhashed = request.path.split('/index.php/')[1] + request.headers['X-Request-Timestamp']
+            hashed = hmac.new(str.encode(self.private_key), msg=unhashed.encode('utf-8'),
+                              digestmod=hashlib.sha256).hexdigest()
+            self.assertEqual(request.headers['X-Request-Hash'], hashed)
+
+    def test_unlock_reason_per_call(self):
+        """The unlock reason is only sent with unlock_password."""
+        with requests_mock.Mocker() as m:
+            m.put(api_url + 'passwords/4/unlock.json', status_code=204)
+            m.get(api_url + 'passwords/4.json', json={'id': 4})
+            self.client.unlock_password('4', 'because I can')
+            self.client.show_password('4')
+            history = m.request_history
+        self.assertEqual(history[0].headers.get('X-Unlock-Reason'), 'because I can')
+        self.assertEqual(history[1].headers.get('X-Unlock-Reason'), None)
+
+    def test_base_headers_read_only(self):
+        """Base headers can not be changed by requests."""
+        with self.assertRaises(TypeError):
+            self.client.headers['X-Request-Hash'] = 'wrong'
+
+    def test_last_response_per_thread(self):
+        """The last response is kept per thread."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            self.client.get_version()
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                other = executor.submit(lambda: self.client.req).result()
+        self.assertIsNotNone(self.client.req)
+        self.assertIsNone(other)
+
+class BulkTestCases(unittest.TestCase):
+    """Test cases for bulk show functions."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', bulk_workers=4)
+
+    def test_show_passwords(self):
+        """All IDs are returned with their result."""
+        with requests_mock.Mocker() as m:
+            for ID in range(20):
+                m.get(api_url + 'passwords/{}.json'.format(ID), json={'id': ID})
+            response = dict(self.client.show_passwords(range(20)))
+        self.assertEqual(response, {ID: {'id': ID} for ID in range(20)})
+
+    def test_failed_id_does_not_abort(self):
+        """A failing ID returns its exception, the others their results."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects/1.json', json={'id': 1})
+            m.get(api_url + 'projects/2.json', text='not found', status_code=404)
+            m.get(api_url + 'projects/3.json', json={'id': 3})
+            response = dict(self.client.show_projects([1, 2, 3], workers=2))
+        self.assertEqual(response[1], {'id': 1})
+        self.assertIsInstance(response[2], tpm.TPMException)
+        self.assertEqual(response[3], {'id': 3})
+
+    def test_bulk_concurrency_limit(self):
+        """No more calls than workers run at the same time."""
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow(ID):
+            with lock:
+                running.append(ID)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(ID)
+            return ID
+        response = list(self.client.bulk(slow, range(30), workers=3))
+        self.assertEqual(sorted(ID for ID, _ in response), list(range(30)))
+        self.assertLessEqual(max(peak), 3)
+
+    def test_failed_partial(self):
+        """Failures of callables without a name are returned as well."""
+        def fail(reason, ID):
+            raise ValueError(reason)
+        response = dict(self.client.bulk(functools.partial(fail, 'broken'), [1]))
+        self.assertIsInstance(response[1], ValueError)
+
+class BatchTestCases(unittest.TestCase):
+    """Test cases for running batches of operations."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+
+    def test_batch_reports(self):
+        """Every operation gets a report with result or error."""
+        operations = [
+            {'key': 'new', 'function': 'create_password', 'args': [{'name': 'new'}]},
+            {'key': 'update', 'function': 'update_password', 'args': ['1', {'name': 'changed'}]},
+            {'key': 'missing', 'function': 'delete_password', 'args': ['2']},
+            {'key': 'wrong', 'function': 'no_such_function'},
+        ]
+        with requests_mock.Mocker() as m:
+            m.post(api_url + 'passwords.json', json={'id': 42})
+            m.put(api_url + 'passwords/1.json', status_code=204)
+            m.delete(api_url + 'passwords/2.json', text='not found', status_code=404)
+            reports = {report['key']: report for report in self.client.run_batch(operations, workers=2)}
+        self.assertTrue(reports['new']['ok'])
+        self.assertEqual(reports['new']['result'], 42)
+        self.assertTrue(reports['update']['ok'])
+        self.assertFalse(reports['missing']['ok'])
+        self.assertTrue(reports['missing']['error'].startswith('TPMException'))
+        self.assertFalse(reports['wrong']['ok'])
+        for report in reports.values():
+            self.assertGreaterEqual(report['elapsed'], 0)
+            json.dumps(report)
+
+    def test_batch_resume(self):
+        """Finished operations are skipped."""
+        operations = [{'function': 'delete_password', 'args': [ID]} for ID in range(5)]
+        with requests_mock.Mocker() as m:
+            for ID in range(5):
+                m.delete(api_url + 'passwords/{}.json'.format(ID), status_code=204)
+            reports = list(self.client.run_batch(operations, done=[0, 1, 2]))
+        self.assertEqual(sorted(report['key'] for report in reports), [3, 4])
+        self.assertEqual(m.call_count, 2)
+
+class RetryTestCases(unittest.TestCase):
+    """Test cases for retrying failed requests."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                                   retry=tpm.Retry(retries=2, backoff=0.001))
+
+    def test_retry_on_503(self):
+        """GET requests are retried on 503."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', [{'text': 'unavailable', 'status_code': 503},
+                                                 {'json': {'id': 1}}])
+            response = self.client.show_password('1')
+        self.assertEqual(response, {'id': 1})
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(self.client.stats['retries'], 1)
+        self.assertEqual(self.client.stats['retries_get'], 1)
+
+    def test_retry_on_connection_error(self):
+        """PUT requests are retried on connection errors until retries run out."""
+        with requests_mock.Mocker() as m:
+            m.put(api_url + 'passwords/1.json', exc=requests.exceptions.ConnectTimeout)
+            with self.assertRaises(tpm.TPMException):
+                self.client.update_password('1', {'name': 'new'})
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(self.client.stats['errors'], 1)
+
+    def test_no_retry_of_post(self):
+        """POST requests are not retried by default."""
+        with requests_mock.Mocker() as m:
+            m.post(api_url + 'passwords.json', exc=requests.exceptions.ConnectionError)
+            with self.assertRaises(tpm.TPMException):
+                self.client.create_password({'name': 'new'})
+        self.assertEqual(m.call_count, 1)
+
+    def test_retry_post_enabled(self):
+        """POST requests are retried with retry_post."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              retry=tpm.Retry(backoff=0.001, retry_post=True))
+        with requests_mock.Mocker() as m:
+            m.post(api_url + 'passwords.json', [{'exc': requests.exceptions.ConnectionError},
+                                                {'json': {'id': 42}}])
+            response = client.create_password({'name': 'new'})
+        self.assertEqual(response, 42)
+
+    def test_retry_disabled(self):
+        """No retries with retry=0."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', retry=0)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', text='unavailable', status_code=503)
+            with self.assertRaises(ValueError):
+                client.show_password('1')
+        self.assertEqual(m.call_count, 1)
+
+    def test_backoff_is_capped(self):
+        """Backoff grows exponentially up to backoff_max."""
+        retry = tpm.Retry(backoff=1, backoff_max=5)
+        for attempt in range(10):
+            self.assertLessEqual(retry.delay(attempt), min(5, 2 ** attempt))
+        self.assertEqual(retry.delay(0, retry_after='3'), 3)
+
+class RateLimiterTestCases(unittest.TestCase):
+    """Test cases for the rate limiter."""
+    def test_burst_then_rate(self):
+        """A burst is free, further requests wait for new tokens."""
+        limiter = tpm.RateLimiter(rate=10, burst=3)
+        for _ in range(3):
+            self.assertEqual(limiter.reserve('get'), 0)
+        self.assertAlmostEqual(limiter.reserve('get'), 0.1, places=2)
+        self.assertGreater(limiter.wait_time('get'), 0.1)
+
+    def test_separate_budgets(self):
+        """Reads and writes use their own budget."""
+        limiter = tpm.RateLimiter(rate=10, burst=1, write_rate=1, write_burst=1)
+        limiter.reserve('get')
+        self.assertEqual(limiter.wait_time('put'), 0)
+        limiter.reserve('put')
+        self.assertGreater(limiter.wait_time('delete'), 0.9)
+
+    def test_shared_between_clients(self):
+        """Clients sharing a limiter share the budget."""
+        limiter = tpm.RateLimiter(rate=50, burst=2)
+        clients = [tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', rate_limiter=limiter)
+                   for _ in range(2)]
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            start = time.monotonic()
+            for _ in range(3):
+                for client in clients:
+                    client.get_version()
+            elapsed = time.monotonic() - start
+        # 6 requests with a burst of 2 need at least 4 new tokens
+        self.assertGreaterEqual(elapsed, 4 / 50.0 - 0.01)
+        self.assertEqual(sum(client.stats['rate_limited'] for client in clients), 4)
+
+class AdaptiveLimiterTestCases(unittest.TestCase):
+    """Test cases for the adaptive concurrency limit."""
+    def test_increase_with_flat_latency(self):
+        """The limit grows while latency stays flat."""
+        limiter = tpm.AdaptiveLimiter(initial=2, maximum=8)
+        for _ in range(50):
+            limiter.observe(0.1)
+        self.assertEqual(limiter.limit, 8)
+
+    def test_decrease_on_error(self):
+        """The limit is cut on errors, once per round."""
+        limiter = tpm.AdaptiveLimiter(initial=8, maximum=8)
+        for _ in range(8):
+            limiter.observe(0.1)
+        for _ in range(4):
+            limiter.observe(0.1, failed=True)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_decrease_on_latency(self):
+        """The limit is cut if latency rises."""
+        limiter = tpm.AdaptiveLimiter(initial=8, maximum=8, tolerance=2)
+        for _ in range(8):
+            limiter.observe(0.1)
+        limiter.observe(1.0)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_baseline_per_kind(self):
+        """Slow kinds of requests are not compared to fast ones."""
+        limiter = tpm.AdaptiveLimiter(initial=16, maximum=16, tolerance=2)
+        for _ in range(200):
+            limiter.observe(0.03, key='get passwords/count.json')
+            for _ in range(3):
+                limiter.observe(0.25, key='get passwords/page/#.json')
+        self.assertEqual(limiter.limit, 16)
+        limiter.observe(1.0, key='get passwords/page/#.json')
+        self.assertEqual(limiter.limit, 8)
+
+    def test_latency_key(self):
+        """Requests differing in IDs, pages or search strings are of a kind."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+        self.assertEqual(client.latency_key('get', 'passwords/page/2.json'), 'get passwords/page/#.json')
+        self.assertEqual(client.latency_key('get', client.url + 'passwords/page/3.json'), 'get passwords/page/#.json')
+        self.assertEqual(client.latency_key('put', 'passwords/12/lock.json'), 'put passwords/#/lock.json')
+        self.assertEqual(client.latency_key('get', 'passwords/search/name:1.json'), 'get passwords/search')
+
+    def test_first_failure_cuts(self):
+        """The first failure cuts the limit at once."""
+        limiter = tpm.AdaptiveLimiter(initial=8, maximum=8)
+        limiter.observe(0.1, failed=True)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_limit_gates_requests(self):
+        """No more than limit requests are sent at once."""
+        limiter = tpm.AdaptiveLimiter(initial=2, maximum=2)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', concurrency=limiter)
+        peak = []
+        lock = threading.Lock()
+
+        def respond(request, context):
+            with lock:
+                peak.append(limiter.inflight)
+            time.sleep(0.01)
+            return {'id': 1}
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', json=respond)
+            response = list(client.show_passwords(['1'] * 10, workers=6))
+        self.assertEqual(len(response), 10)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_bulk_with_parallel_pages(self):
+        """Bulk calls paging concurrently do not wait for each other's slots."""
+        limiter = tpm.AdaptiveLimiter(initial=2, maximum=2)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              concurrency=limiter, page_workers=2)
+        response = []
+        with requests_mock.Mocker() as m:
+            for ID in range(1, 5):
+                path = api_url + 'projects/{}/passwords'.format(ID)
+                m.get(path + '/count.json', json={'num_items': 2, 'num_pages': 2, 'num_items_per_page': 1})
+                m.get(path + '/page/1.json', json=[{'id': ID * 10}])
+                m.get(path + '/page/2.json', json=[{'id': ID * 10 + 1}])
+            crawl = threading.Thread(target=lambda: response.extend(
+                client.bulk(client.list_passwords_of_project, [1, 2, 3, 4])), daemon=True)
+            crawl.start()
+            crawl.join(5)
+        self.assertFalse(crawl.is_alive())
+        self.assertEqual(sorted((ID, [item['id'] for item in items]) for ID, items in response),
+                         [(ID, [ID * 10, ID * 10 + 1]) for ID in range(1, 5)])
+
+    def test_requests_are_observed(self):
+        """Server errors of requests lower the limit."""
+        limiter = tpm.AdaptiveLimiter(initial=4, minimum=1)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              concurrency=limiter, retry=0)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', status_code=503, json={'error': True, 'message': 'down'})
+            with self.assertRaises(tpm.TPMException):
+                client.show_password('1')
+        self.assertEqual(limiter.limit, 2)
+
+class CircuitBreakerTestCases(unittest.TestCase):
+    """Test cases for the circuit breaker."""
+    def setUp(self):
+        self.breaker = tpm.CircuitBreaker(failure_rate=0.5, window=4, minimum=4, reset_timeout=0.05)
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                                   circuit_breaker=self.breaker, retry=0)
+
+    def test_open_after_failures(self):
+        """The breaker opens at the failure rate and fails fast."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', exc=requests.exceptions.ConnectionError)
+            for _ in range(4):
+                with self.assertRaises(tpm.TPMException):
+                    self.client.show_password('1')
+            self.assertEqual(self.breaker.state, 'open')
+            with self.assertRaises(tpm.CircuitOpenError):
+                self.client.show_password('1')
+            calls = m.call_count
+        self.assertEqual(calls, 4)
+        self.assertEqual(self.client.stats['circuit_open'], 1)
+
+    def test_half_open_probe_closes(self):
+        """A successful probe closes the breaker again."""
+        for _ in range(4):
+            self.breaker.record(False)
+        self.assertEqual(self.breaker.state, 'open')
+        time.sleep(0.06)
+        self.assertEqual(self.breaker.state, 'half_open')
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', json={'id': 1})
+            self.client.show_password('1')
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_probe_fails(self):
+        """A failed probe opens the breaker again, only one probe is allowed."""
+        for _ in range(4):
+            self.breaker.record(False)
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_probe_slot_released_on_any_error(self):
+        """A probe ending with an exception of the client gives back its slot."""
+        for _ in range(4):
+            self.breaker.record(False)
+        time.sleep(0.06)
+
+        def transmit(*args, **kwargs):
+            raise ValueError('broken')
+        self.client.transmit = transmit
+        with self.assertRaises(ValueError):
+            self.client.show_password('1')
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertEqual(self.breaker.probing, 0)
+        del self.client.transmit
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', json={'id': 1})
+            self.client.show_password('1')
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_client_errors_are_no_outcome(self):
+        """Exceptions raised by the client feed neither breaker nor limiter."""
+        limiter = tpm.AdaptiveLimiter(initial=8, maximum=8)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              circuit_breaker=self.breaker, concurrency=limiter, retry=0)
+
+        def transmit(*args, **kwargs):
+            raise tpm.DeadlineExceeded('Deadline of 0.5s exceeded')
+        client.transmit = transmit
+        for _ in range(4):
+            with self.assertRaises(tpm.DeadlineExceeded):
+                client.show_password('1')
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.breaker.failure_rate, 0)
+        self.assertEqual(limiter.limit, 8)
+
+    def test_client_errors_do_not_count(self):
+        """4xx responses are no failures of the server."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', text='not found', status_code=404)
+            for _ in range(4):
+                with self.assertRaises(tpm.TPMException):
+                    self.client.show_password('1')
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.breaker.failure_rate, 0)
+
+class TimeoutTestCases(unittest.TestCase):
+    """Test cases for timeouts and deadlines."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                                   connect_timeout=3, read_timeout=20, retry=tpm.Retry(backoff=0.001))
+
+    def test_timeouts_are_passed(self):
+        """Connect and read timeouts are used for every request."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            self.client.get_version()
+            history = m.request_history
+        self.assertEqual(history[0].timeout, (3, 20))
+
+    def test_timeout_cut_to_deadline(self):
+        """Timeouts never exceed the time left."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            with self.client.deadline(1):
+                self.client.get_version()
+            history = m.request_history
+        self.assertLessEqual(history[0].timeout[0], 1)
+        self.assertLessEqual(history[0].timeout[1], 1)
+
+    def test_deadline_checked_before_each_page(self):
+        """A collection stops once the deadline has passed."""
+        def slow_page(request, context):
+            time.sleep(0.03)
+            context.headers['link'] = '<{}passwords/page/2.json>; rel="next"'.format(api_url)
+            return [{'id': 1}]
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', json=slow_page)
+            m.get(api_url + 'passwords/page/2.json', json=[{'id': 2}])
+            with self.assertRaises(tpm.DeadlineExceeded):
+                with self.client.deadline(0.02):
+                    self.client.list_passwords()
+        self.assertEqual(m.call_count, 1)
+
+    def test_deadline_checked_before_retry(self):
+        """No retry is made if the backoff does not fit into the deadline."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              retry=tpm.Retry(retries=5, backoff=10, backoff_max=10))
+        client.retry.delay = lambda attempt, retry_after=None: 10
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', status_code=503, text='unavailable')
+            with self.assertRaises(tpm.DeadlineExceeded):
+                with client.deadline(5):
+                    client.get_version()
+        self.assertEqual(m.call_count, 1)
+
+    def test_deadline_in_bulk_workers(self):
+        """Bulk workers use the deadline of the caller."""
+        with self.client.deadline(0):
+            response = dict(self.client.bulk(lambda ID: self.client.show_password(ID), [1, 2]))
+        self.assertIsInstance(response[1], tpm.DeadlineExceeded)
+        self.assertIsInstance(response[2], tpm.DeadlineExceeded)
+
+    def test_nested_deadline(self):
+        """Nested deadlines can not extend the outer one."""
+        with self.client.deadline(1) as outer:
+            with self.client.deadline(10) as inner:
+                self.assertIs(inner, outer)
+        self.assertIsNone(self.client.current_deadline())
+
+    def test_no_zero_timeout(self):
+        """An expired deadline raises instead of passing timeouts of 0."""
+        with self.client.deadline(0.01):
+            time.sleep(0.02)
+            with self.assertRaises(tpm.DeadlineExceeded):
+                self.client.timeout()
+
+    def test_deadline_bounds_rate_limiter(self):
+        """No token is waited for past the deadline."""
+        limiter = tpm.RateLimiter(rate=0.2)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', rate_limiter=limiter)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            client.get_version()
+            start = time.monotonic()
+            with client.deadline(0.5):
+                with self.assertRaises(tpm.DeadlineExceeded):
+                    client.get_version()
+            calls = m.call_count
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(calls, 1)
+        # the token of the rejected request is given back
+        self.assertGreater(limiter.wait_time(), 4)
+
+    def test_deadline_bounds_concurrency_slot(self):
+        """No concurrency slot is waited for past the deadline."""
+        limiter = tpm.AdaptiveLimiter(initial=1, maximum=1)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', concurrency=limiter)
+        limiter.acquire()
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            start = time.monotonic()
+            with client.deadline(0.2):
+                with self.assertRaises(tpm.DeadlineExceeded):
+                    client.get_version()
+            calls = m.call_count
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(calls, 0)
+        self.assertEqual(limiter.inflight, 1)
+        limiter.release()
+
+class HedgingTestCases(unittest.TestCase):
+    """Test cases for hedged GET requests."""
+    def setUp(self):
+        self.hedging = tpm.Hedging(percentile=90, minimum=5)
+        for _ in range(10):
+            self.hedging.observe(0.02)
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', hedging=self.hedging)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_delay_from_percentile(self):
+        """The hedge delay is the percentile of recent latencies."""
+        hedging = tpm.Hedging(percentile=50, minimum=3)
+        self.assertIsNone(hedging.delay())
+        for latency in (0.1, 0.2, 0.3, 0.4, 0.5):
+            hedging.observe(latency)
+        self.assertEqual(hedging.delay(), 0.3)
+
+    def test_hedge_wins(self):
+        """A slow first request is overtaken by the hedge."""
+        calls = []
+
+        def transmit(action, url, headers, auth, body, stream=False):
+            calls.append(url)
+            response = requests.Response()
+            response.status_code = 200
+            response.url = url
+            if len(calls) == 1:
+                time.sleep(0.3)
+                response._content = b'{"id": "slow"}'
+            else:
+                response._content = b'{"id": "fast"}'
+            response.raw = io.BytesIO(response._content)
+            return response
+        self.client.transmit = transmit
+        response = self.client.show_password('1')
+        self.assertEqual(response, {'id': 'fast'})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0], calls[1])
+        self.assertEqual(self.client.stats['hedges'], 1)
+        self.assertEqual(self.client.stats['hedges_won'], 1)
+        self.assertEqual(self.client.stats['requests'], 2)
+        # the latency of the slow first request is learned once it is done
+        time.sleep(0.4)
+        self.assertGreaterEqual(max(self.hedging.latencies), 0.3)
+
+    def slow_transmit(self, calls):
+        def transmit(action, url, headers, auth, body, stream=False):
+            calls.append(url)
+            time.sleep(0.1)
+            response = requests.Response()
+            response.status_code = 200
+            response.url = url
+            response._content = b'{"id": 1}'
+            return response
+        return transmit
+
+    def test_no_hedge_without_slot(self):
+        """The hedge is skipped if the concurrency limit is reached."""
+        calls = []
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              hedging=self.hedging, concurrency=tpm.AdaptiveLimiter(initial=1, maximum=1))
+        client.transmit = self.slow_transmit(calls)
+        self.assertEqual(client.show_password('1'), {'id': 1})
+        client.close()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(client.stats['hedges_skipped'], 1)
+        self.assertEqual(client.concurrency.inflight, 0)
+
+    def test_no_hedge_without_token(self):
+        """The hedge is skipped if the rate limiter has no token left."""
+        calls = []
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              hedging=self.hedging, rate_limiter=tpm.RateLimiter(rate=1, burst=1))
+        client.transmit = self.slow_transmit(calls)
+        client.show_password('1')
+        client.close()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(client.stats['hedges_skipped'], 1)
+
+    def test_hedge_slot_released(self):
+        """The slot of a hedge is given back once both requests are done."""
+        calls = []
+        limiter = tpm.AdaptiveLimiter(initial=2, maximum=2)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS',
+                              hedging=self.hedging, concurrency=limiter)
+        client.transmit = self.slow_transmit(calls)
+        client.show_password('1')
+        self.assertEqual(len(calls), 2)
+        time.sleep(0.2)
+        client.close()
+        self.assertEqual(limiter.inflight, 0)
+        self.assertEqual(client.stats['requests'], 2)
+
+    def test_no_hedge_if_fast(self):
+        """Fast responses are not hedged."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords/1.json', json={'id': 1})
+            self.client.show_password('1')
+            calls = m.call_count
+        self.assertEqual(calls, 1)
+        self.assertEqual(self.client.stats['hedges'], 0)
+
+    def test_no_hedge_for_writes(self):
+        """Only GET requests are hedged."""
+        def respond(request, context):
+            time.sleep(0.1)
+            return {'id': 42}
+        with requests_mock.Mocker() as m:
+            m.post(api_url + 'passwords.json', json=respond)
+            self.client.create_password({'name': 'new'})
+            calls = m.call_count
+        self.assertEqual(calls, 1)
+
+class CacheTestCases(unittest.TestCase):
+    """Test cases for the response cache."""
+    def setUp(self):
+        self.cache = tpm.ResponseCache(ttl=60, ttls={'version': 0, 'users': 0.05}, maxsize=3)
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', cache=self.cache)
+
+    def test_cache_hit(self):
+        """A second identical GET is served from the cache."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects/4.json', json={'id': 4})
+            first = self.client.show_project('4')
+            first['name'] = 'changed by caller'
+            second = self.client.show_project('4')
+            calls = m.call_count
+        self.assertEqual(calls, 1)
+        self.assertEqual(second, {'id': 4})
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_cached_pages(self):
+        """Collection pages are cached with their next links."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'groups.json', json=[{'id': 1}],
+                  headers={'link': '<{}groups/page/2.json>; rel="next"'.format(api_url)})
+            m.get(api_url + 'groups/page/2.json', json=[{'id': 2}])
+            self.client.list_groups()
+            response = self.client.list_groups()
+            calls = m.call_count
+        self.assertEqual(response, [{'id': 1}, {'id': 2}])
+        self.assertEqual(calls, 2)
+
+    def test_ttl_per_endpoint(self):
+        """Entries expire after the time to live of their endpoint."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'version.json', json={})
+            m.get(api_url + 'users/1.json', json={'id': 1})
+            self.client.get_version()
+            self.client.get_version()
+            self.client.show_user('1')
+            self.client.show_user('1')
+            time.sleep(0.06)
+            self.client.show_user('1')
+            calls = m.call_count
+        self.assertEqual(calls, 4)
+
+    def test_generated_passwords_not_cached(self):
+        """Every call of generate_password gets a new password."""
+        cache = tpm.ResponseCache(ttls={'generate_password': 60})
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', cache=cache)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'generate_password.json',
+                  [{'json': {'password': 'pw0'}}, {'json': {'password': 'pw1'}}])
+            first = client.generate_password()
+            second = client.generate_password()
+            calls = m.call_count
+        self.assertEqual(calls, 2)
+        self.assertEqual((first, second), ({'password': 'pw0'}, {'password': 'pw1'}))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_lru_size(self):
+        """The least recently used entries are evicted."""
+        with requests_mock.Mocker() as m:
+            for ID in range(5):
+                m.get(api_url + 'projects/{}.json'.format(ID), json={'id': ID})
+                self.client.show_project(ID)
+        self.assertEqual(self.cache.stats()['size'], 3)
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+
+    def test_invalidate_on_change(self):
+        """Changes invalidate the cached responses of related resources."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects/4.json', json={'id': 4})
+            m.get(api_url + 'passwords/14.json', json={'id': 14})
+            m.get(api_url + 'groups/1.json', json={'id': 1})
+            m.put(api_url + 'passwords/14/move.json', status_code=204)
+            self.client.show_project('4')
+            self.client.show_password('14')
+            self.client.show_group('1')
+            self.client.move_password('14', '4')
+            self.client.show_project('4')
+            self.client.show_password('14')
+            self.client.show_group('1')
+            calls = m.call_count
+        self.assertEqual(calls, 6)
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+    def test_ttl_prefix_on_segments(self):
+        """A time to live applies to whole path segments only."""
+        self.assertEqual(self.cache.ttl_for('users.json'), 0.05)
+        self.assertEqual(self.cache.ttl_for('users/1.json'), 0.05)
+        self.assertEqual(self.cache.ttl_for('users_ldap.json'), 60)
+        self.assertEqual(self.cache.ttl_for('versions.json'), 60)
+
+    def test_cache_shared_by_users(self):
+        """Clients sharing a cache do not see each other's responses."""
+        other = tpm.TpmApiv5('https://tpm.example.com', username='OTHER', password='PASS', cache=self.cache)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects/4.json', [{'json': {'id': 4, 'name': 'USER'}},
+                                                {'json': {'id': 4, 'name': 'OTHER'}}])
+            self.client.show_project('4')
+            response = other.show_project('4')
+            calls = m.call_count
+        self.assertEqual(calls, 2)
+        self.assertEqual(response['name'], 'OTHER')
+
+    def test_cache_enabled_with_defaults(self):
+        """cache=True uses a cache with default settings."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', cache=True)
+        self.assertIsInstance(client.cache, tpm.ResponseCache)
+
+class CoalesceTestCases(unittest.TestCase):
+    """Test cases for sharing concurrent identical GET requests."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', coalesce=True, retry=0)
+        self.calls = []
+
+    def slow_transmit(self, status_code, content):
+        def transmit(action, url, headers, auth, body, stream=False):
+            self.calls.append(url)
+            time.sleep(0.1)
+            response = requests.Response()
+            response.status_code = status_code
+            response.url = url
+            response._content = content
+            return response
+        return transmit
+
+    def test_identical_gets_share_one_request(self):
+        """Concurrent identical GETs send one request."""
+        self.client.transmit = self.slow_transmit(200, b'{"id": 1}')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: self.client.show_password('1'), range(8)))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [{'id': 1}] * 8)
+        # every caller gets its own result
+        self.assertEqual(len(set(id(result) for result in results)), 8)
+        self.assertEqual(self.client.stats['coalesced'], 7)
+
+    def test_exception_is_shared(self):
+        """All waiting callers get the exception."""
+        self.client.transmit = self.slow_transmit(404, b'not found')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(self.client.show_password, '1') for _ in range(4)]
+            errors = [future.exception() for future in futures]
+        self.assertEqual(len(self.calls), 1)
+        for error in errors:
+            self.assertIsInstance(error, tpm.TPMException)
+
+    def test_different_gets_not_shared(self):
+        """Different paths are requested separately."""
+        self.client.transmit = self.slow_transmit(200, b'{}')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(self.client.show_password, range(4)))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_generated_passwords_not_shared(self):
+        """Concurrent generate_password calls get their own passwords."""
+        transmit = self.slow_transmit(200, b'')
+        numbers = iter(range(5))
+
+        def generate(action, url, headers, auth, body, stream=False):
+            number = next(numbers)
+            response = transmit(action, url, headers, auth, body, stream)
+            response._content = '{{"password": "pw{}"}}'.format(number).encode('utf-8')
+            return response
+        self.client.transmit = generate
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: self.client.generate_password(), range(5)))
+        self.assertEqual(len(self.calls), 5)
+        self.assertEqual(len(set(result['password'] for result in results)), 5)
+        self.assertEqual(self.client.stats['coalesced'], 0)
+
+
+class StreamTestCases(unittest.TestCase):
+    """Test cases for the streaming decode of collection pages."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', stream=True, chunk_size=7)
+
+    def test_items_split_at_every_byte(self):
+        """Items are decoded whatever the chunk boundaries are."""
+        data = [{'id': 1, 'name': 'a, b ] }', 'tags': ['x', 'y']}, 12, -3.5e2, 'ü€',
+                None, True, [], {}, {'nested': [{'deep': [1, [2]]}]}, '\\"]']
+        content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        chunks = [content[i:i + 1] for i in range(len(content))]
+        self.assertEqual(list(tpm.iter_json_array(chunks)), data)
+        self.assertEqual(list(tpm.iter_json_array([content])), data)
+        self.assertEqual(list(tpm.iter_json_array([b' [ ] '])), [])
+        self.assertEqual(list(tpm.iter_json_array([])), [])
+
+    def test_items_yielded_before_the_end(self):
+        """The first item is available before the rest is received."""
+        received = []
+
+        def chunks():
+            for chunk in (b'[{"id": 1}', b', {"id": 2}', b']'):
+                received.append(chunk)
+                yield chunk
+        items = tpm.iter_json_array(chunks())
+        self.assertEqual(next(items), {'id': 1})
+        self.assertEqual(len(received), 1)
+        self.assertEqual(list(items), [{'id': 2}])
+
+    def test_invalid_documents(self):
+        """Other documents than an array raise ValueError."""
+        for content in (b'{"id": 1}', b'[{"id": 1}', b'[1 2]', b'[{"id": }]'):
+            with self.assertRaises(ValueError):
+                list(tpm.iter_json_array([content]))
+
+    def test_streamed_collection(self):
+        """A streamed collection has the same items and follows next links."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', json=[{'id': 1}, {'id': 2}],
+                  headers={'link': '<{}passwords/page/2.json>; rel="next"'.format(api_url)})
+            m.get(api_url + 'passwords/page/2.json', json=[{'id': 3}])
+            response = self.client.list_passwords()
+        self.assertEqual(response, [{'id': 1}, {'id': 2}, {'id': 3}])
+
+    def test_streamed_error(self):
+        """Errors of a streamed request are raised as usual."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', status_code=403, text='forbidden')
+            with self.assertRaises(tpm.TPMException):
+                self.client.list_passwords()
+            m.get(api_url + 'passwords.json', text='[{"id": 1}, broken')
+            with self.assertRaises(ValueError):
+                self.client.list_passwords()
+
+    def test_streamed_error_object(self):
+        """An error object is raised as TPMException, as without stream."""
+        content = ' {"error": true, "type": "Not Found", "message": "Page not found"}'
+        for stream in (True, False):
+            with requests_mock.Mocker() as m:
+                m.get(api_url + 'passwords.json', text=content)
+                with self.assertRaises(tpm.TPMException) as context:
+                    next(self.client.get_collection('passwords.json', stream=stream))
+            self.assertEqual(str(context.exception), 'Page not found')
+
+    def test_download_file(self):
+        """A download is written to a file while it is received."""
+        content = os.urandom(1000)
+        path = os.path.join(os.path.dirname(__file__), 'download.tmp')
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'files/download/4.json', content=content)
+            output = io.BytesIO()
+            self.assertEqual(self.client.download_file('4', output), 1000)
+            try:
+                self.assertEqual(self.client.download_file('4', path), 1000)
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), content)
+            finally:
+                os.remove(path)
+        self.assertEqual(output.getvalue(), content)
+
+
+class CodecTestCases(unittest.TestCase):
+    """Test cases for the pluggable JSON codec."""
+    def test_default_codec(self):
+        """The fastest installed library is used by default."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+        expected = 'orjson' if tpm.orjson else 'ujson' if tpm.ujson else 'json'
+        self.assertEqual(client.codec.name, expected)
+
+    def test_unknown_codec(self):
+        """An unknown or missing library is a configuration error."""
+        with self.assertRaises(tpm.TpmApi.ConfigError):
+            tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', codec='yaml')
+
+    def test_signed_bytes_are_sent(self):
+        """The request hash is calculated over the bytes sent."""
+        private_key = 'private_secret'
+        data = {'name': 'new ü€', 'tags': ['a', 'b'], 'notes': '"quoted"'}
+        for name in ('json', 'orjson', 'ujson'):
+            if getattr(tpm, name) is None:
+                continue
+            client = tpm.TpmApiv5('https://tpm.example.com', private_key=private_key,
+                                  public_key='public_secret', codec=name)
+            with requests_mock.Mocker() as m:
+                m.post(api_url + 'passwords.json', json={'id': 42})
+                self.assertEqual(client.create_password(data), 42)
+                request = m.request_history[0]
+            self.assertEqual(json.loads(request.body), data)
+            unhashed = ('api/v5/passwords.json' + request.headers['X-Request-Timestamp']).encode('utf-8') + request.body
+            hashed = hmac.new(str.encode(private_key), msg=unhashed,
+                              digestmod=hashlib.sha256).hexdigest()
+            self.assertEqual(request.headers['X-Request-Hash'], hashed, name)
+
+    def test_custom_codec(self):
+        """Any object with dumps and loads can be used."""
+        calls = []
+
+        class Codec(object):
+            def dumps(self, data):
+                calls.append('dumps')
+                return json.dumps(data).encode('utf-8')
+
+            def loads(self, content):
+                calls.append('loads')
+                return json.loads(content)
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', codec=Codec())
+        with requests_mock.Mocker() as m:
+            m.post(api_url + 'passwords.json', json={'id': 42})
+            self.assertEqual(client.create_password({'name': 'new'}), 42)
+        self.assertEqual(calls, ['dumps', 'loads'])
+
+
+class LazyCollectionTestCases(unittest.TestCase):
+    """Test cases for lazy collections."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', lazy=True)
+
+    def mock_pages(self, m, pages=3, per_page=2):
+        for page in range(1, pages + 1):
+            url = api_url + ('passwords.json' if page == 1 else 'passwords/page/{}.json'.format(page))
+            headers = {}
+            if page < pages:
+                headers['link'] = '<{}passwords/page/{}.json>; rel="next"'.format(api_url, page + 1)
+            items = [{'id': (page - 1) * per_page + i} for i in range(per_page)]
+            m.get(url, json=items, headers=headers)
+
+    def test_pages_on_demand(self):
+        """Only the pages needed are requested."""
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            passwords = self.client.list_passwords()
+            self.assertIsInstance(passwords, tpm.Collection)
+            self.assertEqual(m.call_count, 0)
+            self.assertEqual(passwords.first(), {'id': 0})
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual([item['id'] for item in passwords.take(3)], [0, 1, 2])
+            self.assertEqual(m.call_count, 2)
+            for item in passwords:
+                if item['id'] == 1:
+                    break
+            self.assertEqual(m.call_count, 2)
+            self.assertEqual(passwords[3], {'id': 3})
+            self.assertEqual([item['id'] for item in passwords], list(range(6)))
+            self.assertEqual(m.call_count, 3)
+            # iterating again does not request anything
+            self.assertEqual(len(list(passwords)), 6)
+            self.assertEqual(len(passwords), 6)
+            self.assertEqual(passwords[-1], {'id': 5})
+            self.assertEqual(m.call_count, 3)
+
+    def test_count(self):
+        """count() asks the server for the count of the collection."""
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            m.get(api_url + 'passwords/count.json', json={'num_items': 6, 'num_pages': 3, 'num_items_per_page': 2})
+            passwords = self.client.list_passwords()
+            self.assertEqual(passwords.count(), 6)
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(m.request_history[0].path, '/index.php/api/v5/passwords/count.json')
+            self.assertEqual(passwords.__length_hint__(), 6)
+
+    def test_count_without_count(self):
+        """count() gets all items if there is no count."""
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            m.get(api_url + 'passwords/count.json', status_code=404, text='not found')
+            self.assertEqual(self.client.list_passwords().count(), 6)
+
+    def test_list_without_count(self):
+        """list() and len() send the same requests as without lazy."""
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            m.get(api_url + 'passwords/count.json', json={'num_items': 6, 'num_pages': 3, 'num_items_per_page': 2})
+            self.assertEqual(len(list(self.client.list_passwords())), 6)
+            self.assertEqual(len(sorted(self.client.list_passwords(), key=lambda item: item['id'])), 6)
+            self.assertEqual(len(self.client.list_passwords()), 6)
+            paths = [request.path for request in m.request_history]
+        self.assertEqual(m.call_count, 9)
+        self.assertNotIn('/index.php/api/v5/passwords/count.json', paths)
+
+    def test_empty_collection(self):
+        """An empty collection is false and has no first item."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'groups.json', json=[])
+            groups = self.client.list_groups()
+            self.assertFalse(groups)
+            self.assertIsNone(groups.first())
+            self.assertEqual(groups.take(5), [])
+
+    def test_failure_starts_over(self):
+        """After a failed page the collection starts over."""
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            m.get(api_url + 'passwords/page/2.json', status_code=403, text='forbidden')
+            passwords = self.client.list_passwords()
+            with self.assertRaises(tpm.TPMException):
+                [item for item in passwords]
+            self.mock_pages(m)
+            self.assertEqual([item['id'] for item in passwords], list(range(6)))
+
+
+class MirrorTestCases(unittest.TestCase):
+    """Test cases for the local SQLite mirror."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+        self.mirror = tpm.Mirror(self.client)
+
+    def tearDown(self):
+        self.mirror.close()
+
+    def mock_collections(self, m):
+        for resource in ('projects', 'passwords', 'users', 'groups'):
+            fake_data(api_url + resource + '.json', m)
+
+    def test_sync(self):
+        """All items are copied on the first sync, then only changes."""
+        passwords = json.load(open('tests/resources/passwords.json'))
+        with requests_mock.Mocker() as m:
+            self.mock_collections(m)
+            report = self.mirror.sync()
+            self.assertEqual(report['passwords'], {'added': len(passwords), 'updated': 0, 'deleted': 0, 'failed': 0, 'unchanged': 0})
+            self.assertEqual(report['users']['added'], 9)
+            report = self.mirror.sync()
+            self.assertEqual(report['passwords'], {'added': 0, 'updated': 0, 'deleted': 0, 'failed': 0, 'unchanged': len(passwords)})
+            self.assertEqual(report['groups']['unchanged'], 4)
+            changed = dict(passwords[0], name='changed', updated_on='2030-01-01 00:00:00')
+            m.get(api_url + 'passwords.json', json=[changed] + passwords[2:])
+            report = self.mirror.sync(['passwords'])
+        self.assertEqual(report['passwords'], {'added': 0, 'updated': 1, 'deleted': 1, 'failed': 0, 'unchanged': len(passwords) - 2})
+        self.assertEqual(self.mirror.show_password(changed['id'])['name'], 'changed')
+        self.assertIsNone(self.mirror.show_password(passwords[1]['id']))
+        self.assertIsNotNone(self.mirror.synced_on('passwords'))
+
+    def test_queries(self):
+        """Queries are answered from the database."""
+        with requests_mock.Mocker() as m:
+            self.mock_collections(m)
+            self.mirror.sync()
+            calls = m.call_count
+            tagged = self.mirror.list_passwords(tag='WordPress')
+            self.assertIn(68, [item['id'] for item in tagged])
+            for item in tagged:
+                self.assertIn('wordpress', item['tags'].lower().split(','))
+            self.assertEqual(len(self.mirror.list_passwords(project_id=18)), 7)
+            self.assertEqual(self.mirror.list_passwords(access_info='http://www.fictionalgadgetsite.com/wp-admin')[0]['id'], 68)
+            self.assertEqual(self.mirror.list_passwords(name='wordpress ADMIN')[0]['id'], 68)
+            self.assertIn(68, [item['id'] for item in self.mirror.list_passwords_search('fictionalgadget')])
+            self.assertEqual(self.mirror.list_passwords_search('100%_'), [])
+            self.assertEqual(self.mirror.list_projects(name='www.fictionalgadgetsite.com')[0]['id'], 18)
+            self.assertTrue(self.mirror.list_projects_search('client'))
+            self.assertEqual(self.mirror.list_users(username='alan')[0]['name'], 'Alan Hall')
+            self.assertEqual(self.mirror.show_group('3')['name'], 'External users')
+            self.assertEqual(m.call_count, calls)
+
+    def test_details(self):
+        """With details, changed passwords are stored with all fields."""
+        mirror = tpm.Mirror(self.client, details=True)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', json=[{'id': 14, 'name': 'VPS db', 'updated_on': '2016-09-07 04:41:44'}])
+            fake_data(api_url + 'passwords/14.json', m)
+            mirror.sync(['passwords'])
+            calls = m.call_count
+            mirror.sync(['passwords'])
+            self.assertEqual(m.call_count, calls + 1)
+        self.assertEqual(mirror.show_password(14)['password'], 'fdaaidd3')
+        self.assertEqual(mirror.list_passwords(tag='vps')[0]['id'], 14)
+        mirror.close()
+
+    def test_failed_details_are_retried(self):
+        """A password whose details fail keeps its old row until the next sync."""
+        mirror = tpm.Mirror(self.client, details=True)
+        listed = {'id': 14, 'name': 'VPS db', 'updated_on': '2016-09-07 04:41:44'}
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', json=[listed])
+            fake_data(api_url + 'passwords/14.json', m)
+            mirror.sync(['passwords'])
+            m.get(api_url + 'passwords.json', json=[dict(listed, updated_on='2016-09-08 10:00:00')])
+            m.get(api_url + 'passwords/14.json', text='not found', status_code=404)
+            report = mirror.sync(['passwords'])
+            self.assertEqual(report['passwords']['failed'], 1)
+            self.assertEqual(report['passwords']['updated'], 0)
+            self.assertEqual(mirror.show_password(14)['password'], 'fdaaidd3')
+            fake_data(api_url + 'passwords/14.json', m)
+            report = mirror.sync(['passwords'])
+        self.assertEqual(report['passwords']['updated'], 1)
+        mirror.close()
+
+    def test_persistent(self):
+        """A database file keeps the copy between runs."""
+        path = os.path.join(os.path.dirname(__file__), 'mirror.tmp')
+        try:
+            with requests_mock.Mocker() as m:
+                self.mock_collections(m)
+                with tpm.Mirror(self.client, path) as mirror:
+                    mirror.sync(['groups'])
+                with tpm.Mirror(self.client, path) as mirror:
+                    self.assertEqual(mirror.sync(['groups'])['groups']['unchanged'], 4)
+        finally:
+            os.remove(path)
+
+
+class SearchIndexTestCases(unittest.TestCase):
+    """Test cases for the in-memory search index."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+
+    def mock_collections(self, m):
+        for resource in ('projects', 'passwords', 'my_passwords'):
+            fake_data(api_url + resource + '.json', m)
+
+    def test_queries(self):
+        """Words, prefixes and tags are searched without requests."""
+        index = tpm.SearchIndex(self.client, resources=('passwords', 'projects', 'my_passwords'))
+        with requests_mock.Mocker() as m:
+            self.mock_collections(m)
+            index.refresh()
+            calls = m.call_count
+            self.assertIn(68, [item['id'] for item in index.list_passwords_search('wordpress admin')])
+            self.assertIn(68, [item['id'] for item in index.list_passwords_search('fictional*')])
+            self.assertIn(68, [item['id'] for item in index.list_passwords_search('WP-ADMIN')])
+            tagged = index.list_passwords_search('tag:wordpress')
+            self.assertEqual(sorted(item['id'] for item in tagged), [32, 33, 36, 43, 68])
+            self.assertEqual(index.list_passwords_search('wordpress nosuchword'), [])
+            self.assertIn(18, [item['id'] for item in index.list_projects_search('tag:client')])
+            self.assertEqual([item['name'] for item in index.list_mypasswords_search('face*')], ['facebook'])
+            self.assertEqual(m.call_count, calls)
+
+    def test_bounded(self):
+        """Only the given fields of max_items items are kept."""
+        index = tpm.SearchIndex(self.client, resources=('passwords',), max_items=3, fields=('id', 'name'))
+        with requests_mock.Mocker() as m:
+            self.mock_collections(m)
+            index.refresh()
+            self.assertEqual(len(index.indexes['passwords']['items']), 3)
+            # an incomplete index sends searches to the server
+            m.get(api_url + 'passwords/search/wordpress.json', json=[{'id': 68}])
+            self.assertEqual(index.list_passwords_search('wordpress'), [{'id': 68}])
+            self.assertEqual(m.last_request.path, '/index.php/api/v5/passwords/search/wordpress.json')
+        for item in index.indexes['passwords']['items'].values():
+            self.assertEqual(set(item), {'id', 'name'})
+
+    def test_background_refresh(self):
+        """The index is rebuilt in the background."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects.json', json=[{'id': 1, 'name': 'old'}])
+            with tpm.SearchIndex(self.client, resources=('projects',), interval=0.01) as index:
+                deadline = time.time() + 5
+                while not index.search('projects', 'old') and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(index.list_projects_search('old')[0]['id'], 1)
+                m.get(api_url + 'projects.json', json=[{'id': 1, 'name': 'new'}])
+                while not index.search('projects', 'new') and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(index.search('projects', 'new')[0]['id'], 1)
+            self.assertIsNone(index.thread)
+
+
+class ProjectTreeTestCases(unittest.TestCase):
+    """Test cases for the project hierarchy index."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+        projects = [{'id': 1, 'name': 'Infra', 'parent_id': 0},
+                    {'id': 2, 'name': 'DB', 'parent_id': 1},
+                    {'id': 3, 'name': 'Prod', 'parent_id': 2},
+                    {'id': 4, 'name': 'Dev', 'parent_id': 2},
+                    {'id': 5, 'name': 'Web', 'parent_id': 1},
+                    {'id': 6, 'name': 'Clients', 'parent_id': 0},
+                    {'id': 7, 'name': 'Orphan', 'parent_id': 99}]
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects.json', json=projects)
+            self.tree = tpm.ProjectTree(self.client)
+
+    def test_lookups(self):
+        """The hierarchy is answered from memory."""
+        self.assertEqual(self.tree.roots(), [6, 1, 7])
+        self.assertEqual(self.tree.children(2), [4, 3])
+        self.assertEqual(self.tree.descendants(1), [2, 4, 3, 5])
+        self.assertEqual(self.tree.descendants(3), [])
+        self.assertEqual(self.tree.ancestors(3), [1, 2])
+        self.assertEqual(self.tree.parent(3), 2)
+        self.assertEqual(self.tree.path(3), 'Infra/DB/Prod')
+        self.assertEqual(self.tree.find('Infra/DB/Prod'), 3)
+        self.assertIsNone(self.tree.find('Infra/Prod'))
+        self.assertEqual(self.tree.path(7), 'Orphan')
+        self.assertEqual(len(self.tree), 7)
+        self.assertIn(5, self.tree)
+
+    def test_follows_changes(self):
+        """Changes made with the client are applied to the tree."""
+        with requests_mock.Mocker() as m:
+            m.post(api_url + 'projects.json', json={'id': 8})
+            m.put(api_url + 'projects/8/change_parent.json', status_code=204)
+            m.put(api_url + 'projects/2.json', status_code=204)
+            m.delete(api_url + 'projects/1.json', status_code=204)
+            self.client.create_project({'name': 'Test', 'parent_id': 3})
+            self.assertEqual(self.tree.path(8), 'Infra/DB/Prod/Test')
+            self.client.change_parent_of_project(8, 6)
+            self.assertEqual(self.tree.find('Clients/Test'), 8)
+            self.assertEqual(self.tree.children(3), [])
+            self.client.update_project(2, {'name': 'Databases'})
+            self.assertEqual(self.tree.path(4), 'Infra/Databases/Dev')
+            self.client.delete_project(1)
+            self.assertEqual(m.call_count, 4)
+        self.assertEqual(self.tree.roots(), [6, 7])
+        self.assertNotIn(3, self.tree)
+        self.assertIsNone(self.tree.find('Infra'))
+        self.tree.close()
+        self.assertEqual(self.client.listeners, ())
+
+    def test_changes_rebuild_once(self):
+        """A series of changes is indexed once, on the next lookup."""
+        indexed = []
+        index = self.tree.index
+        self.tree.index = lambda: indexed.append(1) or index()
+        with requests_mock.Mocker() as m:
+            for ID in range(8, 13):
+                m.post(api_url + 'projects.json', json={'id': ID})
+                self.client.create_project({'name': 'New {}'.format(ID), 'parent_id': 6})
+        self.assertEqual(indexed, [])
+        self.assertEqual(len(self.tree.children(6)), 5)
+        self.assertEqual(self.tree.path(12), 'Clients/New 12')
+        self.assertEqual(indexed, [1])
+        self.tree.close()
+
+    def test_failed_change_ignored(self):
+        """Failed requests do not change the tree."""
+        with requests_mock.Mocker() as m:
+            m.put(api_url + 'projects/3/change_parent.json', status_code=403, text='forbidden')
+            with self.assertRaises(tpm.TPMException):
+                self.client.change_parent_of_project(3, 6)
+        self.assertEqual(self.tree.path(3), 'Infra/DB/Prod')
+
+
+class AccessMatrixTestCases(unittest.TestCase):
+    """Test cases for the access matrix crawler."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', bulk_workers=4)
+        self.matrix = tpm.AccessMatrix(self.client)
+
+    def test_crawl(self):
+        """Security listings are crawled into forward and reverse lookups."""
+        with requests_mock.Mocker() as m:
+            fake_data(api_url + 'projects/1/security.json', m)
+            fake_data(api_url + 'passwords/14/security.json', m)
+            m.get(api_url + 'passwords/15/security.json', status_code=403, text='forbidden')
+            self.assertEqual(self.matrix.crawl(projects=[1], passwords=[14, 15]), 3)
+        project = json.load(open('tests/resources/projects/1/security.json'))
+        password = json.load(open('tests/resources/passwords/14/security.json'))
+        self.assertEqual(len(self.matrix), len(project) + len(password))
+        self.assertEqual(list(self.matrix.errors), [('password', 15)])
+        self.assertEqual(self.matrix.permission(6, 'project', 1), 'PRJ_PERM_ACCESS_CREATE_PWD')
+        self.assertEqual(self.matrix.permission(6, 'password', 14), 'PWD_PERM_MANAGE')
+        self.assertIsNone(self.matrix.permission(6, 'password', 15))
+        self.assertEqual(self.matrix.who_can_access('project', 1)[3], 'PRJ_PERM_ACCESS_READ')
+        self.assertEqual(self.matrix.accessible_by(6), {('project', 1): 'PRJ_PERM_ACCESS_CREATE_PWD',
+                                                        ('password', 14): 'PWD_PERM_MANAGE'})
+        self.assertEqual(list(self.matrix.accessible_by(6, 'password')), [('password', 14)])
+
+    def test_no_access_left_out(self):
+        """Entries denying access are not listed as access."""
+        with requests_mock.Mocker() as m:
+            fake_data(api_url + 'projects/3/security.json', m)
+            self.matrix.crawl(projects=[3], passwords=[])
+        listing = json.load(open('tests/resources/projects/3/security.json'))
+        denied = [access['user']['id'] for access in listing if access['permission']['id'] == 0]
+        self.assertTrue(denied)
+        self.assertEqual(len(self.matrix), len(listing) - len(denied))
+        for user in denied:
+            self.assertNotIn(user, self.matrix.who_can_access('project', 3))
+            self.assertEqual(self.matrix.accessible_by(user), {})
+            self.assertIsNone(self.matrix.permission(user, 'project', 3))
+        self.assertEqual(self.matrix.who_can_access('project', 3)[6], 'PRJ_PERM_ACCESS_MANAGE_PWD')
+
+    def test_crawl_all(self):
+        """Without IDs all projects and passwords are crawled."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects.json', json=[{'id': 1}])
+            m.get(api_url + 'passwords.json', json=[{'id': 2}])
+            m.get(api_url + 'projects/1/security.json', json=[
+                {'user': {'id': 5, 'username': 'ann'}, 'permission': {'id': 20, 'label': 'READ'}}])
+            m.get(api_url + 'passwords/2/security.json', json=[
+                {'user': {'id': 5, 'username': 'ann'}, 'permission': {'id': 30, 'label': 'MANAGE'}}])
+            self.matrix.crawl()
+            # a new crawl replaces the entries of an object
+            m.get(api_url + 'passwords/2/security.json', json=[])
+            self.matrix.crawl(projects=[], passwords=[2])
+        self.assertEqual(self.matrix.accessible_by(5), {('project', 1): 'READ'})
+
+    def crawl_with(self, **kwargs):
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', **kwargs)
+        matrix = tpm.AccessMatrix(client)
+        with requests_mock.Mocker() as m:
+            for ID in range(1, 5):
+                path = api_url + 'passwords/{}/security'.format(ID)
+                m.get(path + '.json', json=[
+                    {'user': {'id': ID, 'username': 'user'}, 'permission': {'id': 30, 'label': 'MANAGE'}}])
+                m.get(path + '/count.json', json={'num_items': 1, 'num_pages': 1, 'num_items_per_page': 1})
+                m.get(path + '/page/1.json', json=[
+                    {'user': {'id': ID, 'username': 'user'}, 'permission': {'id': 30, 'label': 'MANAGE'}}])
+            m.get(api_url + 'passwords/5/security.json', status_code=403, text='forbidden')
+            m.get(api_url + 'passwords/5/security/count.json', status_code=403, text='forbidden')
+            m.get(api_url + 'passwords/6/security.json', json=[{'user': 'broken'}])
+            done = []
+            crawl = threading.Thread(target=lambda: done.append(
+                matrix.crawl(projects=[], passwords=range(1, 7))), daemon=True)
+            crawl.start()
+            crawl.join(5)
+        self.assertEqual(done, [6])
+        self.assertEqual(len(matrix), 4)
+        self.assertEqual(sorted(matrix.errors), [('password', 5), ('password', 6)])
+
+    def test_crawl_lazy(self):
+        """A lazy client is crawled in the workers, failures are kept."""
+        self.crawl_with(lazy=True)
+
+    def test_crawl_concurrency_parallel_pages(self):
+        """A concurrency limit does not block concurrent pages of the crawl."""
+        self.crawl_with(concurrency=tpm.AdaptiveLimiter(initial=2, maximum=2), page_workers=2)
+
+    def test_export(self):
+        """Entries are exported as JSON lines."""
+        with requests_mock.Mocker() as m:
+            fake_data(api_url + 'projects/1/security.json', m)
+            self.matrix.crawl(projects=[1], passwords=[])
+        output = io.StringIO()
+        self.assertEqual(self.matrix.export(output), len(self.matrix))
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(rows), len(self.matrix))
+        self.assertIn({'kind': 'project', 'id': 1, 'user_id': 6, 'username': 'alan',
+                       'permission': 'PRJ_PERM_ACCESS_CREATE_PWD', 'granted_via': 'Group: IT work'}, rows)
+
+
+class RecordTestCases(unittest.TestCase):
+    """Test cases for typed results."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', records=True)
+
+    def test_collections(self):
+        """Items of collections are records with the same content."""
+        with requests_mock.Mocker() as m:
+            for resource in ('projects', 'passwords', 'users', 'groups', 'my_passwords'):
+                fake_data(api_url + resource + '.json', m)
+            fake_data(api_url + 'projects/1/security.json', m)
+            for function, record, resource in ((self.client.list_projects, tpm.Project, 'projects'),
+                                               (self.client.list_passwords, tpm.Password, 'passwords'),
+                                               (self.client.list_users, tpm.User, 'users'),
+                                               (self.client.list_groups, tpm.Group, 'groups'),
+                                               (self.client.list_mypasswords, tpm.Password, 'my_passwords')):
+                items = function()
+                expected = json.load(open('tests/resources/{}.json'.format(resource)))
+                self.assertTrue(all(type(item) is record for item in items), resource)
+                key = lambda item: int(item['id'])
+                self.assertEqual(sorted((item.to_dict() for item in items), key=key), sorted(expected, key=key))
+                self.assertEqual(sorted(items, key=key), sorted(expected, key=key))
+            # other resources are not changed
+            self.assertIsInstance(self.client.list_user_access_on_project(1)[0], dict)
+
+    def test_show(self):
+        """Single items are records, fields without slot are kept."""
+        with requests_mock.Mocker() as m:
+            fake_data(api_url + 'passwords/14.json', m)
+            fake_data(api_url + 'files/4.json', m)
+            fake_data(api_url + 'version.json', m)
+            password = self.client.show_password(14)
+            file_info = self.client.show_file_info(4)
+            version = self.client.get_version()
+        self.assertIsInstance(password, tpm.Password)
+        self.assertEqual(password.name, 'VPS db')
+        self.assertEqual(password['project']['id'], 10)
+        self.assertEqual(password.get('custom_field1', 'missing'), None)
+        self.assertEqual(password.get('nothing', 'missing'), 'missing')
+        self.assertIn('custom_field1', password)
+        self.assertNotIn('nothing', password)
+        with self.assertRaises(KeyError):
+            password['nothing']
+        self.assertEqual(password.to_dict(), json.load(open('tests/resources/passwords/14.json')))
+        self.assertIsInstance(file_info, tpm.File)
+        self.assertIsInstance(version, dict)
+
+    def test_record_types(self):
+        """Resources are mapped to their record class."""
+        self.assertIs(tpm.record_type('passwords/search/web.json'), tpm.Password)
+        self.assertIs(tpm.record_type('passwords/page/2.json'), tpm.Password)
+        self.assertIs(tpm.record_type('projects/4/passwords.json'), tpm.Password)
+        self.assertIs(tpm.record_type('projects/4/subprojects/new_pwd.json'), tpm.Project)
+        self.assertIs(tpm.record_type('projects/4/files.json'), tpm.File)
+        self.assertIs(tpm.record_type('users/me.json'), tpm.User)
+        self.assertIsNone(tpm.record_type('passwords/14/security.json'))
+        self.assertIsNone(tpm.record_type('passwords/count.json'))
+
+    def test_smaller_than_dicts(self):
+        """Records take less memory than dicts."""
+        import tracemalloc
+        items = json.load(open('tests/resources/passwords.json'))
+        text = json.dumps(items * 20)
+        tracemalloc.start()
+        dicts = json.loads(text)
+        size_dicts = tracemalloc.get_traced_memory()[0]
+        records = [tpm.Password(item) for item in json.loads(text)]
+        size_records = tracemalloc.get_traced_memory()[0] - size_dicts
+        tracemalloc.stop()
+        self.assertEqual(len(records), len(dicts))
+        self.assertLess(size_records, size_dicts)
+
+
+class DedupeTestCases(unittest.TestCase):
+    """Test cases for sharing nested objects between collection items."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', dedupe=True)
+
+    def test_shared_objects(self):
+        """Equal nested objects and strings are one instance."""
+        with requests_mock.Mocker() as m:
+            fake_data(api_url + 'passwords.json', m)
+            passwords = self.client.list_passwords()
+        expected = json.load(open('tests/resources/passwords.json'))
+        key = lambda item: int(item['id'])
+        self.assertEqual(sorted(passwords, key=key), sorted(expected, key=key))
+        projects = [item['project'] for item in passwords if str(item['project']['id']) == '18']
+        self.assertGreater(len(projects), 1)
+        self.assertTrue(all(project is projects[0] for project in projects))
+        updated = [item['updated_on'] for item in passwords if item['updated_on'] == passwords[0]['updated_on']]
+        self.assertTrue(all(value is updated[0] for value in updated))
+
+    def test_types_kept_apart(self):
+        """Objects that are only equal across types are not shared."""
+        interner = tpm.Interner()
+        first = interner({'a': {'id': 1, 'flag': True}})
+        second = interner({'a': {'id': 1, 'flag': 1}})
+        third = interner({'a': {'id': 1, 'flag': True}, 'b': {'list': [1]}})
+        self.assertIsNot(first['a'], second['a'])
+        self.assertIs(second['a']['flag'], 1)
+        self.assertIs(first['a'], third['a'])
+        self.assertEqual(third['b'], {'list': [1]})
+
+    def test_with_records(self):
+        """Records share the nested objects too."""
+        client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS', dedupe=True, records=True)
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'passwords.json', json=[{'id': 1, 'project': {'id': 2, 'name': 'A'}},
+                                                     {'id': 3, 'project': {'id': 2, 'name': 'A'}}])
+            passwords = client.list_passwords()
+        self.assertIs(passwords[0].project, passwords[1].project)
+
+
+class ColumnsTestCases(unittest.TestCase):
+    """Test cases for the columnar export."""
+    def setUp(self):
+        self.client = tpm.TpmApiv5('https://tpm.example.com', username='USER', password='PASS')
+
+    def test_passwords(self):
+        """Passwords are stored in typed columns."""
+        expected = json.load(open('tests/resources/passwords.json'))
+        with requests_mock.Mocker() as m:
+            fake_data(api_url + 'passwords.json', m)
+            columns = tpm.Columns(self.client).load()
+        items = columns.to_array()
+        self.assertEqual(len(items), len(expected))
+        self.assertEqual(sorted(items['id'].tolist()), sorted(item['id'] for item in expected))
+        row = items['id'].tolist().index(68)
+        self.assertEqual(str(items['updated_on'][row]), '2016-09-07T04:41:45')
+        self.assertTrue(tpm.numpy.isnat(items['expiry_date'][row]))
+        self.assertEqual(columns.categories('project')[items['project'][row]], 'www.fictionalgadgetsite.com')
+        self.assertEqual(columns.categories('tag_set')[items['tag_set'][row]], 'wordpress')
+        self.assertEqual(columns.categories('username')[items['username'][row]], 'admin_sg')
+        self.assertTrue(items['favorite'][row])
+        self.assertEqual(items['created_by'][row], -1)
+        # vectorized counts per project
+        counts = tpm.numpy.bincount(items['project'])
+        project = columns.categories('project').tolist().index('www.fictionalgadgetsite.com')
+        self.assertEqual(counts[project], 7)
+        tags = columns.tags()
+        wordpress = columns.categories('tag').tolist().index('wordpress')
+        self.assertEqual(sorted(items['id'][tags['item'][tags['tag'] == wordpress]].tolist()), [32, 33, 36, 43, 68])
+
+    def test_save(self):
+        """Columns are saved as a .npz file."""
+        with requests_mock.Mocker() as m:
+            m.get(api_url + 'projects.json', json=[
+                {'id': 1, 'name': 'A', 'tags': 'x, Y', 'parent_id': 0, 'archived': False,
+                 'managed_by': {'id': 3, 'name': 'Claire Wood'}, 'updated_on': '2020-01-02 03:04:05'},
+                {'id': 2, 'name': 'B', 'tags': '', 'parent_id': None, 'archived': True}])
+            columns = tpm.Columns(self.client, 'projects.json').load()
+        output = io.BytesIO()
+        columns.save(output)
+        output.seek(0)
+        with tpm.numpy.load(output) as data:
+            items = data['items']
+            self.assertEqual(items['id'].tolist(), [1, 2])
+            self.assertEqual(items['parent_id'][1], -2 ** 63)
+            self.assertEqual(items['managed_by'].tolist(), [3, -1])
+            self.assertEqual(items['archived'].tolist(), [False, True])
+            self.assertEqual(data['tag_set_categories'].tolist(), ['x,y'])
+            self.assertEqual(items['tag_set'].tolist(), [0, -1])
+            self.assertEqual(data['tag_categories'].tolist(), ['x', 'y'])
+            self.assertEqual(data['tags']['item'].tolist(), [0, 0])
+            self.assertEqual(data['users'].tolist(), [(3, 'Claire Wood')])
+
+    def test_invalid_item_adds_nothing(self):
+        """An item with an invalid value leaves no partial row behind."""
+        columns = tpm.Columns(self.client, 'projects.json')
+        columns.add({'id': 1, 'name': 'A', 'tags': 'x', 'managed_by': {'id': 3, 'name': 'Claire Wood'}})
+        with self.assertRaises(ValueError):
+            columns.add({'id': 2, 'tags': 'y', 'managed_by': {'id': 4, 'name': 'Alan Hall'},
+                         'updated_on': 'yesterday'})
+        self.assertEqual(len(columns), 1)
+        self.assertEqual(set(len(buffer) for buffer in columns.buffers.values()), {1})
+        self.assertEqual(columns.categories('tag_set').tolist(), ['x'])
+        self.assertEqual(columns.categories('tag').tolist(), ['x'])
+        self.assertEqual(columns.users()['id'].tolist(), [3])
+
+    def test_unsupported(self):
+        """Only collections with columns can be exported."""
+        with self.assertRaises(tpm.TpmApi.ConfigError):
+            tpm.Columns(self.client, 'groups.json')
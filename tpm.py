@@ -30,15 +30,53 @@ __version__ = '4.2'
 import hmac
 import hashlib
 import time
+import random
 import requests
 import re
 import json
 import logging
 import base64
+import codecs
 import os.path
-
+import sqlite3
+import threading
+import queue
+import collections
+import itertools
+import bisect
+import array
+import calendar
+import functools
+import contextlib
+import asyncio
+import types
+import sys
+import inspect
+
+from concurrent.futures import ThreadPoolExecutor, Future, wait,\
+    FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 from urllib.parse import quote_plus
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # set logger
 log = logging.getLogger(__name__)
 # disable unsecure SSL warning
@@ -49,6 +87,1860 @@ class TPMException(Exception):
     pass
 
 
+class CircuitOpenError(TPMException):
+    """Raised without a request while the circuit breaker is open."""
+    pass
+
+
+class DeadlineExceeded(TPMException):
+    """Raised when an operation runs out of time."""
+    pass
+
+
+class Deadline(object):
+    """Point in time an operation has to be finished by."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        """Return the seconds left, never less than 0."""
+        return max(0.0, self.expires - time.monotonic())
+
+    def check(self, what=''):
+        """Raise DeadlineExceeded if the deadline has passed."""
+        if time.monotonic() >= self.expires:
+            raise DeadlineExceeded('Deadline of {}s exceeded {}'.format(
+                self.seconds, what).strip())
+
+
+class Retry(object):
+    """Retry policy for failed requests.
+
+    Connection errors, timeouts and responses with one of the given status
+    codes are retried up to retries times, with capped exponential backoff
+    and full jitter. POST requests are not idempotent and are only retried
+    with retry_post.
+    """
+    def __init__(self, retries=2, backoff=0.5, backoff_max=30,
+                 statuses=(429, 502, 503, 504), retry_post=False):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.statuses = frozenset(statuses)
+        self.retry_post = retry_post
+
+    def allowed(self, action, attempt):
+        """Check if a request may be retried after attempt failures."""
+        if action == 'post' and not self.retry_post:
+            return False
+        return attempt < self.retries
+
+    def delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before the next attempt."""
+        delay = random.uniform(0, min(self.backoff_max,
+                                      self.backoff * 2 ** attempt))
+        try:
+            # honour a Retry-After header given in seconds
+            delay = max(delay, min(float(retry_after), self.backoff_max))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter for requests.
+
+    One limiter can be attached to several clients and is shared by all their
+    threads. Reads (GET) and writes (POST, PUT, DELETE) have separate budgets:
+    rate is the number of requests per second, burst the number of requests
+    that may be sent at once after a quiet period.
+    """
+    def __init__(self, rate=10, burst=None, write_rate=None, write_burst=None):
+        if write_rate is None:
+            write_rate = rate
+        now = time.monotonic()
+        self.lock = threading.Lock()
+        self.buckets = {}
+        for kind, kind_rate, kind_burst in (('read', rate, burst),
+                                            ('write', write_rate, write_burst)):
+            if kind_burst is None:
+                kind_burst = max(1, kind_rate)
+            self.buckets[kind] = {'rate': float(kind_rate),
+                                  'burst': float(kind_burst),
+                                  'tokens': float(kind_burst),
+                                  'updated': now}
+
+    @staticmethod
+    def kind(action):
+        """Return the budget used by a request method."""
+        return 'read' if action == 'get' else 'write'
+
+    def refill(self, bucket, now):
+        """Add the tokens earned since the last update."""
+        bucket['tokens'] = min(bucket['burst'], bucket['tokens'] +
+                               (now - bucket['updated']) * bucket['rate'])
+        bucket['updated'] = now
+
+    def wait_time(self, action='get'):
+        """Return the seconds a request would have to wait right now."""
+        with self.lock:
+            bucket = self.buckets[self.kind(action)]
+            self.refill(bucket, time.monotonic())
+            if bucket['tokens'] >= 1:
+                return 0.0
+            return (1 - bucket['tokens']) / bucket['rate']
+
+    def reserve(self, action='get', timeout=None):
+        """Take a token and return the seconds to wait before using it.
+
+        With timeout, no token is taken and None is returned if the wait
+        would be longer.
+        """
+        with self.lock:
+            bucket = self.buckets[self.kind(action)]
+            self.refill(bucket, time.monotonic())
+            bucket['tokens'] -= 1
+            if bucket['tokens'] >= 0:
+                return 0.0
+            delay = -bucket['tokens'] / bucket['rate']
+            if timeout is not None and delay > timeout:
+                bucket['tokens'] += 1
+                return None
+            return delay
+
+    def acquire(self, action='get', timeout=None):
+        """Wait until a request may be sent, return the seconds waited.
+
+        With timeout, None is returned at once if the wait would be longer.
+        """
+        delay = self.reserve(action, timeout)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def try_acquire(self, action='get'):
+        """Take a token if one is free right now, return if it was."""
+        with self.lock:
+            bucket = self.buckets[self.kind(action)]
+            self.refill(bucket, time.monotonic())
+            if bucket['tokens'] < 1:
+                return False
+            bucket['tokens'] -= 1
+            return True
+
+
+class AdaptiveLimiter(object):
+    """Adaptive limit for concurrent requests (AIMD).
+
+    The limit grows by one per round of successful requests as long as the
+    latency stays within tolerance times the best latency seen for the same
+    kind of request, and is cut by factor on timeouts, connection errors, 5xx
+    and 429 responses or rising latency. Kinds of requests are told apart by
+    the key passed to observe, so slow pages are not compared to fast counts.
+    limit can be read at any time for monitoring.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, tolerance=2.0,
+                 factor=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.factor = factor
+        self.current = float(min(max(initial, minimum), maximum))
+        # best latency per kind of request
+        self.baselines = {}
+        self.inflight = 0
+        # observations since the last decrease, to cut once per round only;
+        # a full round has passed before the first one
+        self.since_decrease = self.limit
+        self.condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The current number of allowed concurrent requests."""
+        return int(self.current)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self, timeout=None):
+        """Wait for a free slot, return False if none was free in time."""
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.inflight < self.limit, timeout):
+                return False
+            self.inflight += 1
+            return True
+
+    def try_acquire(self):
+        """Take a slot if one is free right now, return if it was."""
+        with self.condition:
+            if self.inflight >= self.limit:
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self):
+        """Free a slot."""
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify()
+
+    def observe(self, latency, failed=False, key=None):
+        """Adjust the limit to the latency and outcome of a request.
+
+        key is the kind of the request, its latency is only compared to
+        those of the same kind.
+        """
+        with self.condition:
+            self.since_decrease += 1
+            baseline = self.baselines.get(key)
+            if not failed:
+                if baseline is None or latency < baseline:
+                    baseline = latency
+                else:
+                    # let the baseline follow slow, lasting changes
+                    baseline += (latency - baseline) * 0.01
+                self.baselines[key] = baseline
+            congested = failed or (baseline is not None and
+                                   latency > baseline * self.tolerance)
+            if congested:
+                if self.since_decrease >= self.limit:
+                    self.current = max(self.minimum,
+                                       self.current * self.factor)
+                    self.since_decrease = 0
+                    log.info('Concurrency limit decreased to {}'.format(
+                        self.limit))
+            else:
+                self.current = min(self.maximum,
+                                   self.current + 1.0 / self.current)
+            self.condition.notify_all()
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for a failing server.
+
+    While closed, the outcome of the last window requests is tracked. If at
+    least minimum of them were made and the share of failures (connection
+    errors, timeouts, 5xx and 429 responses) reaches failure_rate, the
+    breaker opens and requests fail fast with CircuitOpenError. After
+    reset_timeout seconds it is half open and lets probes requests through;
+    it closes again if they succeed and opens again if one fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate=0.5, window=20, minimum=5,
+                 reset_timeout=30, probes=1):
+        self.failure_rate_threshold = failure_rate
+        self.window = window
+        self.minimum = minimum
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened = 0
+        self.probing = 0
+        self.current = self.CLOSED
+
+    @property
+    def state(self):
+        """The current state: closed, open or half_open."""
+        with self.lock:
+            return self.update_state()
+
+    @property
+    def failure_rate(self):
+        """Share of failures of the tracked requests."""
+        with self.lock:
+            if not self.outcomes:
+                return 0.0
+            return self.outcomes.count(False) / float(len(self.outcomes))
+
+    def update_state(self):
+        """Return the state, half open once the reset timeout is over.
+
+        Must be called with the lock held.
+        """
+        if self.current == self.OPEN and\
+                time.monotonic() - self.opened >= self.reset_timeout:
+            log.info('Circuit breaker half open.')
+            self.current = self.HALF_OPEN
+            self.probing = 0
+        return self.current
+
+    def trip(self):
+        """Open the breaker, must be called with the lock held."""
+        log.warning('Circuit breaker open for {}s.'.format(self.reset_timeout))
+        self.current = self.OPEN
+        self.opened = time.monotonic()
+        self.outcomes.clear()
+
+    def allow(self):
+        """Check if a request may be sent now."""
+        with self.lock:
+            state = self.update_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self.probing < self.probes:
+                self.probing += 1
+                return True
+            return False
+
+    def release(self):
+        """Give back a probe slot of a request without an outcome.
+
+        For requests that were allowed but not answered by the server, e.g.
+        because the client gave up on them.
+        """
+        with self.lock:
+            if self.update_state() == self.HALF_OPEN:
+                self.probing = max(0, self.probing - 1)
+
+    def record(self, success):
+        """Record the outcome of a request."""
+        with self.lock:
+            state = self.update_state()
+            if state == self.HALF_OPEN:
+                self.probing = max(0, self.probing - 1)
+                if success:
+                    log.info('Circuit breaker closed.')
+                    self.current = self.CLOSED
+                    self.outcomes.clear()
+                else:
+                    self.trip()
+            elif state == self.CLOSED:
+                self.outcomes.append(success)
+                failures = self.outcomes.count(False)
+                if len(self.outcomes) >= self.minimum and failures >=\
+                        self.failure_rate_threshold * len(self.outcomes):
+                    self.trip()
+
+
+class Hedging(object):
+    """Settings and latency statistics for hedged GET requests.
+
+    If a GET request has not been answered after the given percentile of
+    the recent GET latencies, a second identical request is sent and the
+    first response wins. Hedging starts once minimum latencies are known.
+    """
+    def __init__(self, percentile=95, window=200, minimum=20, min_delay=0.01):
+        self.percentile = percentile
+        self.minimum = minimum
+        self.min_delay = min_delay
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Return the seconds to wait before hedging, None if unknown yet."""
+        with self.lock:
+            if len(self.latencies) < self.minimum:
+                return None
+            latencies = sorted(self.latencies)
+        index = int(round((len(latencies) - 1) * self.percentile / 100.0))
+        return max(self.min_delay, latencies[index])
+
+    def observe(self, latency):
+        """Record the latency of a GET request."""
+        with self.lock:
+            self.latencies.append(latency)
+
+
+class ResponseCache(object):
+    """LRU cache for the responses of GET requests.
+
+    ttl is the default time to live in seconds, ttls maps API paths to their
+    own time to live, the longest prefix of whole path segments wins, e.g.
+    {'version': 3600, 'passwords': 10} ('users' does not match 'users_ldap').
+    A time to live of 0 disables caching for that path, resources that answer
+    differently every time, like generate_password, are never cached. At most
+    maxsize responses are kept. Changes made by the client invalidate the cached
+    responses of the affected resources. One cache can be shared by several
+    clients, their responses are kept apart by server and credentials.
+    """
+    # resources whose responses may change when another resource is changed
+    RELATED = {
+        'passwords': ('passwords', 'projects', 'my_passwords', 'files'),
+        'projects': ('projects', 'passwords'),
+        'my_passwords': ('my_passwords', 'passwords', 'projects'),
+        'favorite_passwords': ('passwords',),
+        'favorite_project': ('projects',),
+        'users': ('users', 'groups', 'passwords', 'projects'),
+        'users_ldap': ('users', 'groups'),
+        'users_saml': ('users', 'groups'),
+        'groups': ('groups', 'users', 'passwords', 'projects'),
+        'files': ('files', 'passwords', 'projects'),
+    }
+    # resources with a new response for every request
+    UNCACHED = ('generate_password',)
+
+    def __init__(self, ttl=60, ttls=None, maxsize=1024):
+        self.ttl = ttl
+        self.ttls = sorted((ttls or {}).items(), key=lambda item: -len(item[0]))
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # changes with every invalidation, see set
+        self.generation = 0
+
+    def ttl_for(self, resource):
+        """Return the time to live for a path relative to the API."""
+        if resource.split('/', 1)[0].split('.', 1)[0] in self.UNCACHED:
+            return 0
+        for prefix, ttl in self.ttls:
+            if resource.startswith(prefix) and (prefix.endswith('/') or
+                    resource[len(prefix):len(prefix) + 1] in ('', '/', '.')):
+                return ttl
+        return self.ttl
+
+    def get(self, key):
+        """Return the cached value of key, None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, resource, value, generation=None):
+        """Cache value under key for the time to live of resource.
+
+        If generation is given and there was an invalidation since it was
+        read, the value may be outdated and is not cached.
+        """
+        ttl = self.ttl_for(resource)
+        if not ttl:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + ttl, value, resource)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, resource):
+        """Drop the cached responses affected by a change of resource."""
+        name = resource.split('/', 1)[0].split('.', 1)[0]
+        prefixes = self.RELATED.get(name, (name,))
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items()
+                        if entry[2].split('/', 1)[0].split('.', 1)[0]
+                        in prefixes]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop all cached responses."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return hits, misses, evictions, invalidations and size."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'size': len(self.entries)}
+
+
+class SingleFlight(object):
+    """Share one call between threads asking for the same key at once."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, timeout=None):
+        """Call function, or wait for the call already running for key.
+
+        Returns the result and whether this thread made the call. Waiting
+        threads get the exception of the call, if it failed.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result(timeout), False
+        try:
+            result = function()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result, True
+
+
+class JsonCodec(object):
+    """Encode and decode JSON bodies with orjson or ujson, if installed.
+
+    name chooses the library: 'orjson', 'ujson' or 'json' for the standard
+    library. By default the fastest one installed is used. Bodies are encoded
+    to UTF-8 bytes, which are signed and sent as they are.
+    """
+    def __init__(self, name=None):
+        if name is None:
+            if orjson is not None:
+                name = 'orjson'
+            elif ujson is not None:
+                name = 'ujson'
+            else:
+                name = 'json'
+        modules = {'orjson': orjson, 'ujson': ujson, 'json': json}
+        if name not in modules:
+            raise ValueError('Unknown JSON codec: {}'.format(name))
+        if modules[name] is None:
+            raise ValueError('JSON codec {} is not installed'.format(name))
+        self.name = name
+
+    def dumps(self, data):
+        """Return data encoded as JSON in UTF-8 bytes."""
+        if self.name == 'orjson':
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        elif self.name == 'ujson':
+            return ujson.dumps(data, ensure_ascii=False).encode('utf-8')
+        return json.dumps(data).encode('utf-8')
+
+    def loads(self, content):
+        """Decode JSON from bytes or a string, raise ValueError if invalid."""
+        if self.name == 'orjson':
+            return orjson.loads(content)
+        elif self.name == 'ujson':
+            return ujson.loads(content)
+        return json.loads(content)
+
+
+def iter_json_array(chunks):
+    """Decode the items of a JSON array from chunks of bytes as they arrive.
+
+    Each item is yielded as soon as it is complete, so only the item being
+    decoded is held in memory instead of the whole document. Raises
+    ValueError if the document is not a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    whitespace = re.compile(r'[ \t\n\r]*')
+    # an item can only be complete once one of these has been received
+    delimiter = re.compile(r'[]},]')
+    buffer = ''
+    position = 0
+    scanned = 0
+    state = 'start'
+    final = False
+    chunks = iter(chunks)
+    while not final:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buffer += text.decode(b'' if final else chunk, final)
+        while True:
+            position = whitespace.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if state == 'start':
+                if char != '[':
+                    raise ValueError('Expected a JSON array, got: {}'.format(
+                        buffer[position:position + 50]))
+                state = 'first'
+                position += 1
+            elif state == 'separator':
+                if char == ']':
+                    return
+                if char != ',':
+                    raise ValueError('Expected , or ] at: {}'.format(
+                        buffer[position:position + 50]))
+                state = 'item'
+                position += 1
+            elif state == 'first' and char == ']':
+                return
+            else:
+                if not final and not delimiter.search(
+                        buffer, max(position, scanned)):
+                    scanned = len(buffer)
+                    break
+                try:
+                    item, position = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if final:
+                        raise
+                    scanned = len(buffer)
+                    break
+                state = 'separator'
+                yield item
+        buffer = buffer[position:]
+        scanned = max(scanned - position, 0)
+        position = 0
+    if state != 'start':
+        raise ValueError('Incomplete JSON array')
+
+
+class Interner(object):
+    """Share equal nested objects and strings between the items of a listing.
+
+    Nested objects, like the project, created_by and updated_by of the
+    passwords, are replaced by the first equal object seen, strings and keys
+    by the first equal string. Shared objects must not be changed, as the
+    change would show in all items sharing them.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.strings = {}
+
+    def __call__(self, item):
+        """Return a copy of an item with shared nested objects and strings."""
+        if isinstance(item, dict):
+            return dict((self.value(key), self.value(value))
+                        for key, value in item.items())
+        return self.value(item)
+
+    def value(self, value):
+        """Return the shared instance of a value."""
+        if isinstance(value, str):
+            return self.strings.setdefault(value, value)
+        elif isinstance(value, dict):
+            value = self(value)
+            # the type keeps e.g. 1 and True apart
+            try:
+                key = tuple(sorted((name, type(field), field)
+                                   for name, field in value.items()))
+                return self.objects.setdefault(key, value)
+            except TypeError:
+                # objects with lists or objects in them are not shared
+                return value
+        elif isinstance(value, list):
+            return [self.value(element) for element in value]
+        return value
+
+
+class Record(object):
+    """Base of the typed results, a compact item of the API.
+
+    The fields of an item are kept in slots instead of a dict, fields without
+    a slot are kept in extra. Fields can be read as attributes, or like a
+    dict with record['name'] and record.get('name'). to_dict() returns the
+    item as a dict again.
+    """
+    __slots__ = ('extra',)
+    fields = ()
+
+    def __init__(self, item):
+        extra = None
+        for key, value in item.items():
+            if key in self.fields:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self.extra = extra
+
+    def to_dict(self):
+        """Return the item as a dict, like it was received."""
+        item = {}
+        for name in self.fields:
+            try:
+                item[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        if self.extra:
+            item.update(self.extra)
+        return item
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """Return a field, or default if the item does not have it."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<{} {}: {}>'.format(type(self).__name__, self.get('id'),
+                                    self.get('name'))
+
+
+class Project(Record):
+    """A project, see Record."""
+    __slots__ = fields = (
+        'id', 'name', 'tags', 'archived', 'favorite', 'num_files',
+        'num_passwords', 'managed_by', 'updated_on', 'parent_id', 'parents',
+        'notes', 'created_on', 'created_by', 'updated_by', 'is_leaf',
+        'user_permission', 'users_permissions', 'groups_permissions',
+        'grant_all_permission', 'user_can_create_passwords')
+
+
+class Password(Record):
+    """A password or my password, see Record."""
+    __slots__ = fields = (
+        'id', 'name', 'tags', 'access_info', 'username', 'email', 'password',
+        'project', 'archived', 'locked', 'favorite', 'num_files',
+        'expiry_date', 'expiry_status', 'external_sharing', 'external_url',
+        'notes_snippet', 'notes', 'updated_on', 'created_on', 'created_by',
+        'updated_by', 'managed_by', 'parents', 'user_permission',
+        'users_permissions', 'groups_permissions')
+
+
+class User(Record):
+    """A user, see Record."""
+    __slots__ = fields = (
+        'id', 'username', 'name', 'email_address', 'role', 'is_active',
+        'is_ldap', 'is_2fa_enabled', 'valid_hash', 'num_groups', 'groups',
+        'login_dn', 'last_login', 'last_api_request', 'created_on',
+        'created_by', 'updated_on', 'updated_by')
+
+
+class Group(Record):
+    """A group, see Record."""
+    __slots__ = fields = (
+        'id', 'name', 'num_users', 'users', 'created_on', 'created_by',
+        'updated_on', 'updated_by')
+
+
+class File(Record):
+    """A file, see Record."""
+    __slots__ = fields = (
+        'id', 'name', 'container', 'notes', 'size_bytes', 'size_txt',
+        'uploaded_on', 'uploaded_by', 'notes_updated_on', 'notes_updated_by')
+
+
+# record class of the items of each resource, paths without page
+record_types = (
+    (re.compile(r'^(files/\d+|(projects|passwords)/\d+/files)\.json$'), File),
+    (re.compile(r'^projects/\d+/passwords\.json$'), Password),
+    (re.compile(r'^projects(/(archived|favorite|search/[^/]+|\d+|'
+                r'\d+/subprojects(/[^/]+)?))?\.json$'), Project),
+    (re.compile(r'^(passwords|my_passwords)'
+                r'(/(archived|favorite|search/[^/]+|\d+))?\.json$'), Password),
+    (re.compile(r'^users(/(\d+|me))?\.json$'), User),
+    (re.compile(r'^groups(/\d+)?\.json$'), Group),
+)
+
+
+def record_type(resource):
+    """Return the record class for the items of a resource, None if none."""
+    resource = re.sub(r'/page/\d+\.json$', '.json', resource)
+    for pattern, record in record_types:
+        if pattern.match(resource):
+            return record
+    return None
+
+
+def synchronous(client, user):
+    """Return client, raise ConfigError for an asyncio client."""
+    if client.asynchronous:
+        raise TpmApi.ConfigError('{} needs a synchronous client'.format(
+            type(user).__name__))
+    return client
+
+
+class Collection(object):
+    """A collection of the API, its pages are requested when they are needed.
+
+    Items already received are kept, so the collection can be iterated again
+    without new requests. len() receives all items, as list() calls it to
+    size the list and must not cost an extra request; count() asks the server
+    for the count of the collection instead. If a request fails the
+    collection starts over with the first page when it is used again.
+    """
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.items = []
+        self.pages = None
+        self.complete = False
+        self.num_items = None
+        self.lock = threading.RLock()
+
+    def fetch(self, size=None):
+        """Receive items until there are size of them, or all if None."""
+        with self.lock:
+            if self.pages is None and not self.complete:
+                self.pages = self.client.get_collection(self.path)
+            try:
+                while not self.complete and\
+                        (size is None or len(self.items) < size):
+                    try:
+                        self.items.append(self.client.to_record(
+                            self.path, next(self.pages)))
+                    except StopIteration:
+                        log.debug('Received all {} items of {}'.format(
+                            len(self.items), self.path))
+                        self.complete = True
+                        self.pages = None
+            except Exception:
+                self.items = []
+                self.pages = None
+                raise
+
+    def close(self):
+        """Stop receiving pages, e.g. to end a prefetch early."""
+        with self.lock:
+            if self.pages is not None:
+                self.pages.close()
+                self.pages = None
+                self.items = []
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index >= len(self.items):
+                self.fetch(index + 1)
+                if index >= len(self.items):
+                    return
+            yield self.items[index]
+            index += 1
+
+    def __len__(self):
+        self.fetch()
+        return len(self.items)
+
+    def __length_hint__(self):
+        with self.lock:
+            if self.complete or self.num_items is None:
+                return len(self.items)
+            return self.num_items
+
+    def count(self):
+        """Return the number of items, asking the server if not all are here.
+
+        Gets all items if the collection has no count.
+        """
+        with self.lock:
+            if self.complete:
+                return len(self.items)
+            if self.num_items is None:
+                try:
+                    count = self.client.get(self.client.count_path(self.path))
+                    self.num_items = int(count.get('num_items'))
+                except (TPMException, ValueError, TypeError,
+                        AttributeError) as e:
+                    log.debug('No count for {} ({}), get all items.'
+                              .format(self.path, e))
+                    return len(self)
+            return self.num_items
+
+    def __bool__(self):
+        self.fetch(1)
+        return bool(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if stop is None or stop < 0 or (start or 0) < 0 or\
+                    (step or 1) < 0:
+                self.fetch()
+            else:
+                self.fetch(stop)
+        elif index < 0:
+            self.fetch()
+        else:
+            self.fetch(index + 1)
+        return self.items[index]
+
+    def __repr__(self):
+        return '<Collection {}: {} items received{}>'.format(
+            self.path, len(self.items), '' if self.complete else ' so far')
+
+    def first(self):
+        """Return the first item, None if the collection is empty."""
+        for item in self:
+            return item
+        return None
+
+    def take(self, n):
+        """Return a list of the first n items."""
+        return list(itertools.islice(self, n))
+
+
+class Mirror(object):
+    """A local SQLite copy of projects, passwords, users and groups.
+
+    sync() crawls the collections and only writes the rows that were added,
+    changed (by their updated_on) or deleted since the last sync. Queries are
+    then answered from the database without requests to the server.
+    Passwords are stored as listed, without the password itself, unless
+    details is set: then changed passwords are requested with show_password
+    and stored with all their fields, secrets included.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY, name TEXT COLLATE NOCASE,
+            tags TEXT COLLATE NOCASE, parent_id INTEGER, archived INTEGER,
+            updated_on TEXT, version TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS passwords (
+            id INTEGER PRIMARY KEY, name TEXT COLLATE NOCASE,
+            tags TEXT COLLATE NOCASE, project_id INTEGER,
+            access_info TEXT COLLATE NOCASE, username TEXT COLLATE NOCASE,
+            email TEXT COLLATE NOCASE, archived INTEGER, updated_on TEXT,
+            version TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY, username TEXT COLLATE NOCASE,
+            name TEXT COLLATE NOCASE, email_address TEXT COLLATE NOCASE,
+            version TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY, name TEXT COLLATE NOCASE,
+            version TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS tags (
+            resource TEXT, tag TEXT, id INTEGER,
+            PRIMARY KEY (resource, tag, id));
+        CREATE TABLE IF NOT EXISTS syncs (
+            resource TEXT PRIMARY KEY, synced_on REAL, items INTEGER);
+        CREATE INDEX IF NOT EXISTS projects_name ON projects (name);
+        CREATE INDEX IF NOT EXISTS projects_parent ON projects (parent_id);
+        CREATE INDEX IF NOT EXISTS passwords_name ON passwords (name);
+        CREATE INDEX IF NOT EXISTS passwords_project ON passwords (project_id);
+        CREATE INDEX IF NOT EXISTS passwords_access_info
+            ON passwords (access_info);
+        CREATE INDEX IF NOT EXISTS users_username ON users (username);
+        CREATE INDEX IF NOT EXISTS groups_name ON groups (name);
+        CREATE INDEX IF NOT EXISTS tags_id ON tags (resource, id);
+    """
+    # collection and columns of each table, besides id, version and data
+    resources = {
+        'projects': ('projects.json', ('name', 'tags', 'parent_id',
+                                       'archived', 'updated_on')),
+        'passwords': ('passwords.json', ('name', 'tags', 'project_id',
+                                         'access_info', 'username', 'email',
+                                         'archived', 'updated_on')),
+        'users': ('users.json', ('username', 'name', 'email_address')),
+        'groups': ('groups.json', ('name',)),
+    }
+    searched = {
+        'projects': ('name', 'tags'),
+        'passwords': ('name', 'tags', 'access_info', 'username', 'email'),
+    }
+
+    def __init__(self, client, path=':memory:', details=False):
+        self.client = synchronous(client, self)
+        self.path = path
+        self.details = details
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def split_tags(tags):
+        """Return the set of lower case tags of a comma separated string."""
+        return set(tag.strip().lower() for tag in (tags or '').split(',')
+                   if tag.strip())
+
+    @staticmethod
+    def column(item, name):
+        """Return the value of a column for an item of a collection."""
+        if name == 'project_id':
+            return (item.get('project') or {}).get('id')
+        value = item.get(name)
+        if isinstance(value, bool):
+            return int(value)
+        return value
+
+    def sync(self, resources=None):
+        """Bring the local copy up to date, return what has changed.
+
+        Returns a dict with the numbers of added, updated, deleted and
+        unchanged items of every resource.
+        """
+        if resources is None:
+            resources = list(self.resources)
+        report = {}
+        for resource in resources:
+            report[resource] = self.sync_resource(resource)
+        return report
+
+    def sync_resource(self, resource):
+        """Sync one table with its collection."""
+        path, columns = self.resources[resource]
+        start = time.time()
+        with self.lock:
+            known = dict(self.db.execute(
+                'SELECT id, version FROM {}'.format(resource)))
+        changed = {}
+        seen = set()
+        for item in self.client.get_collection(path):
+            ID = int(item['id'])
+            seen.add(ID)
+            # lists without updated_on are compared by their content
+            version = item.get('updated_on') or json.dumps(item,
+                                                           sort_keys=True)
+            if known.get(ID) != version:
+                changed[ID] = (version, item)
+        failed = set()
+        if self.details and resource == 'passwords' and changed:
+            for ID, details in self.client.show_passwords(list(changed)):
+                if isinstance(details, Exception):
+                    # keep the old row and version, the next sync retries
+                    log.warning('Keep password {} as it was: {}'
+                                .format(ID, details))
+                    del changed[ID]
+                    failed.add(ID)
+                    continue
+                if isinstance(details, Record):
+                    details = details.to_dict()
+                changed[ID] = (changed[ID][0], details)
+        deleted = set(known) - seen
+        insert = 'INSERT OR REPLACE INTO {} (id, version, data, {}) VALUES ' \
+                 '({})'.format(resource, ', '.join(columns),
+                               ', '.join('?' * (len(columns) + 3)))
+        with self.lock, self.db:
+            self.db.executemany(insert, (
+                [ID, version, json.dumps(item)] +
+                [self.column(item, name) for name in columns]
+                for ID, (version, item) in changed.items()))
+            self.db.executemany('DELETE FROM {} WHERE id = ?'.format(
+                resource), ((ID,) for ID in deleted))
+            if 'tags' in columns:
+                self.db.executemany(
+                    'DELETE FROM tags WHERE resource = ? AND id = ?',
+                    ((resource, ID) for ID in set(changed) | deleted))
+                self.db.executemany(
+                    'INSERT INTO tags (resource, tag, id) VALUES (?, ?, ?)',
+                    ((resource, tag, ID) for ID, (_, item) in changed.items()
+                     for tag in self.split_tags(item.get('tags'))))
+            self.db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)',
+                            (resource, start, len(seen)))
+        added = len(set(changed) - set(known))
+        result = {'added': added, 'updated': len(changed) - added,
+                  'deleted': len(deleted), 'failed': len(failed),
+                  'unchanged': len(seen) - len(changed) - len(failed)}
+        log.info('Synced {}: {}'.format(resource, result))
+        return result
+
+    def synced_on(self, resource):
+        """Return the time of the last sync of a resource, None if never."""
+        with self.lock:
+            row = self.db.execute('SELECT synced_on FROM syncs '
+                                  'WHERE resource = ?', (resource,)).fetchone()
+        return row[0] if row else None
+
+    def query(self, resource, where=(), parameters=()):
+        """Return the items of a table matching all where clauses."""
+        sql = 'SELECT data FROM {}'.format(resource)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self.lock:
+            rows = self.db.execute(sql + ' ORDER BY name', parameters)
+            return [json.loads(data) for data, in rows]
+
+    def filters(self, resource, name=None, tag=None, **columns):
+        """Return where clauses and parameters for the given values."""
+        where, parameters = [], []
+        if name is not None:
+            where.append('name = ?')
+            parameters.append(name)
+        if tag is not None:
+            where.append('id IN (SELECT id FROM tags WHERE resource = ? '
+                         'AND tag = ?)')
+            parameters.extend((resource, tag.strip().lower()))
+        for column, value in columns.items():
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                parameters.append(value)
+        return where, parameters
+
+    def search(self, resource, searchstring):
+        """Return the items with searchstring in one of the searched fields."""
+        pattern = '%{}%'.format(searchstring.replace('\\', '\\\\')
+                                .replace('%', '\\%').replace('_', '\\_'))
+        where = ['({})'.format(' OR '.join(
+            "{} LIKE ? ESCAPE '\\'".format(column)
+            for column in self.searched[resource]))]
+        return self.query(resource, where,
+                          [pattern] * len(self.searched[resource]))
+
+    def get(self, resource, ID):
+        """Return one item of a table, None if it is not known."""
+        with self.lock:
+            row = self.db.execute('SELECT data FROM {} WHERE id = ?'.format(
+                resource), (int(ID),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_projects(self, name=None, tag=None, parent_id=None):
+        """List projects, optionally by exact name, tag or parent."""
+        return self.query('projects', *self.filters(
+            'projects', name, tag, parent_id=parent_id))
+
+    def list_projects_search(self, searchstring):
+        """List projects with searchstring in their name or tags."""
+        return self.search('projects', searchstring)
+
+    def show_project(self, ID):
+        """Show a project as listed."""
+        return self.get('projects', ID)
+
+    def list_passwords(self, name=None, tag=None, project_id=None,
+                       access_info=None):
+        """List passwords, optionally by name, tag, project or access info."""
+        return self.query('passwords', *self.filters(
+            'passwords', name, tag, project_id=project_id,
+            access_info=access_info))
+
+    def list_passwords_search(self, searchstring):
+        """List passwords with searchstring in one of the listed fields."""
+        return self.search('passwords', searchstring)
+
+    def show_password(self, ID):
+        """Show a password as listed, or with all fields if details is set."""
+        return self.get('passwords', ID)
+
+    def list_users(self, username=None):
+        """List users, optionally by username."""
+        return self.query('users', *self.filters('users', username=username))
+
+    def show_user(self, ID):
+        """Show a user as listed."""
+        return self.get('users', ID)
+
+    def list_groups(self, name=None):
+        """List groups, optionally by exact name."""
+        return self.query('groups', *self.filters('groups', name))
+
+    def show_group(self, ID):
+        """Show a group as listed."""
+        return self.get('groups', ID)
+
+
+class SearchIndex(object):
+    """An in-memory inverted index of passwords, projects and my passwords.
+
+    The index is built from one crawl of each collection and answers the
+    searches of list_*_search without requests. A query matches the items
+    containing all of its terms: a word, a prefix like 'data*' or a tag like
+    'tag:server'. Only the given fields of at most max_items items per
+    collection are kept. If a collection has more items, or has not been
+    indexed yet, its searches are sent to the server. With interval the index
+    is rebuilt in a background thread every interval seconds.
+    """
+    paths = {'passwords': 'passwords.json',
+             'projects': 'projects.json',
+             'my_passwords': 'my_passwords.json'}
+    searched = ('name', 'tags', 'access_info', 'username', 'email')
+    word = re.compile(r'\w+')
+
+    def __init__(self, client, resources=('passwords', 'projects'),
+                 interval=None, max_items=100000,
+                 fields=('id', 'name', 'tags', 'access_info', 'username',
+                         'email', 'project', 'updated_on')):
+        self.client = synchronous(client, self)
+        self.resources = resources
+        self.interval = interval
+        self.max_items = max_items
+        self.fields = fields
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        if interval:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def tokenize(self, text):
+        """Return the lower case words of a text."""
+        return self.word.findall(str(text or '').lower())
+
+    def build(self, resource):
+        """Crawl a collection and return its index."""
+        items = {}
+        words = collections.defaultdict(set)
+        tags = collections.defaultdict(set)
+        complete = True
+        for item in self.client.get_collection(self.paths[resource]):
+            if len(items) >= self.max_items:
+                log.warning('More than {} {}, search them on the server.'
+                            .format(self.max_items, resource))
+                complete = False
+                break
+            ID = int(item['id'])
+            if self.fields:
+                item = dict((key, item[key]) for key in self.fields
+                            if key in item)
+            items[ID] = item
+            for field in self.searched:
+                for token in self.tokenize(item.get(field)):
+                    words[token].add(ID)
+            for tag in (item.get('tags') or '').split(','):
+                if tag.strip():
+                    tags[tag.strip().lower()].add(ID)
+        words = dict((sys.intern(token), frozenset(IDs))
+                     for token, IDs in words.items())
+        return {'items': items,
+                'words': words,
+                'vocabulary': sorted(words),
+                'tags': dict((tag, frozenset(IDs))
+                             for tag, IDs in tags.items()),
+                'complete': complete}
+
+    def refresh(self):
+        """Rebuild the index of every resource."""
+        for resource in self.resources:
+            start = time.time()
+            index = self.build(resource)
+            # searches running meanwhile keep using the previous index
+            with self.lock:
+                self.indexes[resource] = index
+            log.debug('Indexed {} {} in {:.3f}s'.format(
+                len(index['items']), resource, time.time() - start))
+
+    def start(self):
+        """Rebuild the index every interval seconds in the background."""
+        def run():
+            while not self.stopped.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    log.warning('Refresh of the search index failed: {}'
+                                .format(e))
+                self.stopped.wait(self.interval)
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=run, name='tpm-index',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background refresh."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def match(self, index, term):
+        """Return the IDs of the items matching one term of a query."""
+        if term.startswith('tag:'):
+            return index['tags'].get(term[len('tag:'):].strip(), frozenset())
+        if term.endswith('*'):
+            tokens = self.tokenize(term)
+            if not tokens:
+                return frozenset(index['items'])
+            IDs = set()
+            vocabulary = index['vocabulary']
+            position = bisect.bisect_left(vocabulary, tokens[-1])
+            while position < len(vocabulary) and\
+                    vocabulary[position].startswith(tokens[-1]):
+                IDs.update(index['words'][vocabulary[position]])
+                position += 1
+            for token in tokens[:-1]:
+                IDs.intersection_update(index['words'].get(token, ()))
+            return IDs
+        IDs = None
+        for token in self.tokenize(term):
+            found = index['words'].get(token, frozenset())
+            IDs = found if IDs is None else IDs & found
+        return frozenset(index['items']) if IDs is None else IDs
+
+    def search(self, resource, query):
+        """Return the items matching a query, None if not indexed."""
+        with self.lock:
+            index = self.indexes.get(resource)
+        if index is None or not index['complete']:
+            return None
+        IDs = None
+        for term in query.lower().split():
+            found = self.match(index, term)
+            IDs = found if IDs is None else IDs & found
+            if not IDs:
+                return []
+        if IDs is None:
+            IDs = index['items']
+        return sorted((index['items'][ID] for ID in IDs),
+                      key=lambda item: str(item.get('name', '')).lower())
+
+    def list_passwords_search(self, searchstring):
+        """List passwords matching searchstring."""
+        result = self.search('passwords', searchstring)
+        if result is None:
+            return self.client.list_passwords_search(searchstring)
+        return result
+
+    def list_projects_search(self, searchstring):
+        """List projects matching searchstring."""
+        result = self.search('projects', searchstring)
+        if result is None:
+            return self.client.list_projects_search(searchstring)
+        return result
+
+    def list_mypasswords_search(self, searchstring):
+        """List my passwords matching searchstring."""
+        result = self.search('my_passwords', searchstring)
+        if result is None:
+            return self.client.list_mypasswords_search(searchstring)
+        return result
+
+
+class ProjectTree(object):
+    """An in-memory index of the project hierarchy.
+
+    The tree is built from one crawl of projects.json using the parent_id of
+    every project. Children, descendants, ancestors and paths like
+    'Infra/DB/Prod' are then looked up without requests. The tree follows
+    the projects created, renamed, moved and deleted with the client, other
+    changes are picked up by refresh(). A change only marks the lookups as
+    outdated, they are rebuilt once on the next lookup, so a series of
+    changes costs one rebuild.
+    """
+    change = re.compile(r'^projects/(\d+)(/change_parent)?\.json$')
+
+    def __init__(self, client, separator='/'):
+        self.client = synchronous(client, self)
+        self.separator = separator
+        self.lock = threading.RLock()
+        self.names = {}
+        self.parents = {}
+        self.refresh()
+        client.add_listener(self.changed)
+
+    def close(self):
+        """Stop following the changes made with the client."""
+        self.client.remove_listener(self.changed)
+
+    def refresh(self):
+        """Crawl all projects and rebuild the tree."""
+        names, parents = {}, {}
+        for project in self.client.get_collection('projects.json'):
+            ID = int(project['id'])
+            names[ID] = project.get('name', '')
+            parents[ID] = int(project.get('parent_id') or 0)
+        with self.lock:
+            self.names, self.parents = names, parents
+            self.index()
+
+    def index(self):
+        """Compute the lookups from the names and parents of the projects."""
+        children = collections.defaultdict(list)
+        for ID, parent in self.parents.items():
+            # projects with an unknown parent, e.g. an archived one, are roots
+            children[parent if parent in self.names else 0].append(ID)
+        for IDs in children.values():
+            IDs.sort(key=lambda ID: (self.names[ID].lower(), ID))
+        # projects in depth first order, the descendants of a project follow
+        # it, so they are a slice of the order
+        order, positions, lineages = [], {}, {}
+        stack = list(reversed(children[0]))
+        for ID in stack:
+            lineages[ID] = ()
+        while stack:
+            ID = stack.pop()
+            positions[ID] = len(order)
+            order.append(ID)
+            for child in reversed(children.get(ID, ())):
+                lineages[child] = lineages[ID] + (ID,)
+                stack.append(child)
+        sizes = {}
+        for ID in reversed(order):
+            sizes[ID] = 1 + sum(sizes[child] for child in children.get(ID, ()))
+        paths, IDs = {}, {}
+        for ID in order:
+            paths[ID] = self.separator.join(
+                self.names[other] for other in lineages[ID] + (ID,))
+            IDs.setdefault(paths[ID], ID)
+        if len(order) < len(self.names):
+            log.warning('{} projects are part of a cycle'.format(
+                len(self.names) - len(order)))
+        self.tree = {'children': dict(children), 'order': order,
+                     'positions': positions, 'sizes': sizes,
+                     'lineages': lineages, 'paths': paths, 'IDs': IDs}
+
+    def changed(self, action, resource, data, result):
+        """Apply a change made with the client to the tree."""
+        if resource == 'projects.json' and action == 'post':
+            with self.lock:
+                ID = int(result['id'])
+                self.names[ID] = data.get('name', '')
+                self.parents[ID] = int(data.get('parent_id') or 0)
+                self.tree = None
+            return
+        match = self.change.match(resource)
+        if match is None:
+            return
+        ID = int(match.group(1))
+        with self.lock:
+            if ID not in self.names:
+                return
+            if match.group(2) and action == 'put':
+                self.parents[ID] = int(data.get('parent_id') or 0)
+            elif action == 'put' and data and 'name' in data:
+                self.names[ID] = data['name']
+            elif action == 'delete':
+                for other in [ID] + self.descendants(ID):
+                    del self.names[other]
+                    del self.parents[other]
+            else:
+                return
+            self.tree = None
+
+    def lookups(self):
+        """Return the lookups, rebuilt first if the tree has changed."""
+        tree = self.tree
+        if tree is None:
+            with self.lock:
+                if self.tree is None:
+                    self.index()
+                tree = self.tree
+        return tree
+
+    def __contains__(self, ID):
+        return int(ID) in self.lookups()['positions']
+
+    def __len__(self):
+        return len(self.lookups()['order'])
+
+    def roots(self):
+        """Return the IDs of the top level projects."""
+        return list(self.lookups()['children'].get(0, ()))
+
+    def children(self, ID):
+        """Return the IDs of the subprojects of a project."""
+        return list(self.lookups()['children'].get(int(ID), ()))
+
+    def descendants(self, ID):
+        """Return the IDs of all projects below a project, depth first."""
+        tree = self.lookups()
+        position = tree['positions'][int(ID)]
+        return tree['order'][position + 1:position + tree['sizes'][int(ID)]]
+
+    def ancestors(self, ID):
+        """Return the IDs of the projects above a project, top level first."""
+        return list(self.lookups()['lineages'][int(ID)])
+
+    def parent(self, ID):
+        """Return the ID of the parent of a project, 0 for top level."""
+        lineage = self.lookups()['lineages'][int(ID)]
+        return lineage[-1] if lineage else 0
+
+    def path(self, ID):
+        """Return the names from the top level to a project, e.g. 'A/B/C'."""
+        return self.lookups()['paths'][int(ID)]
+
+    def find(self, path):
+        """Return the ID of the project with a path, None if there is none."""
+        return self.lookups()['IDs'].get(path)
+
+
+class AccessMatrix(object):
+    """A sparse matrix of the access of users to projects and passwords.
+
+    crawl() requests the security listings of projects and passwords
+    concurrently, with the bulk workers of the client. Every entry is a user,
+    an object like ('password', 14) and a permission. Entries are kept in
+    both directions, to look up who can access an object and what a user can
+    access. Entries denying access (permission 0, e.g. PRJ_PERM_NO_ACCESS)
+    are left out. Permission labels, usernames and grants are interned, so
+    each is stored once.
+    """
+    def __init__(self, client):
+        self.client = synchronous(client, self)
+        self.forward = {}
+        self.reverse = {}
+        self.usernames = {}
+        self.errors = {}
+
+    def crawl(self, projects=None, passwords=None, workers=None):
+        """Request the access to the given projects and passwords, or all.
+
+        Returns the number of objects crawled. Objects that failed are
+        skipped and their errors kept in errors.
+        """
+        if projects is None:
+            projects = (project['id'] for project in
+                        self.client.get_collection('projects.json'))
+        if passwords is None:
+            passwords = (password['id'] for password in
+                         self.client.get_collection('passwords.json'))
+        objects = itertools.chain(
+            (('project', int(ID)) for ID in projects),
+            (('password', int(ID)) for ID in passwords))
+        count = 0
+        for key, result in self.client.bulk(self.fetch, objects, workers):
+            count += 1
+            if isinstance(result, Exception):
+                self.errors[key] = '{}: {}'.format(type(result).__name__,
+                                                   result)
+                continue
+            try:
+                self.add(key, result)
+            except (TypeError, ValueError, AttributeError) as e:
+                self.errors[key] = '{}: {}'.format(type(e).__name__, e)
+                continue
+            self.errors.pop(key, None)
+        log.info('Crawled access to {} objects, {} failed'.format(
+            count, len(self.errors)))
+        return count
+
+    def fetch(self, key):
+        """Return the security listing of one object.
+
+        All its pages are requested here, in the worker. The list functions
+        of a lazy client would leave that to the thread of crawl().
+        """
+        kind, ID = key
+        return list(self.client.get_collection(
+            '{}s/{}/security.json'.format(kind, ID)))
+
+    def add(self, key, listing):
+        """Replace the entries of an object with its security listing."""
+        for user in self.forward.pop(key, {}):
+            del self.reverse[user][key]
+        entries = {}
+        for access in listing:
+            user = access.get('user') or {}
+            permission = access.get('permission') or {}
+            if user.get('id') is None or not permission.get('label'):
+                continue
+            if str(permission.get('id')) == '0' or\
+                    permission['label'].endswith('_NO_ACCESS'):
+                continue
+            user_ID = int(user['id'])
+            self.usernames.setdefault(user_ID,
+                                      sys.intern(user.get('username', '')))
+            entries[user_ID] = (sys.intern(permission['label']),
+                                sys.intern(access.get('granted_via') or ''))
+            self.reverse.setdefault(user_ID, {})[key] = entries[user_ID]
+        if entries:
+            self.forward[key] = entries
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.forward.values())
+
+    def permission(self, user, kind, ID):
+        """Return the permission label of a user on an object, or None."""
+        entry = self.forward.get((kind, int(ID)), {}).get(int(user))
+        return entry[0] if entry else None
+
+    def who_can_access(self, kind, ID):
+        """Return {user ID: permission label} of an object."""
+        return dict((user, entry[0]) for user, entry in
+                    self.forward.get((kind, int(ID)), {}).items())
+
+    def accessible_by(self, user, kind=None):
+        """Return {(kind, ID): permission label} of a user."""
+        return dict((key, entry[0]) for key, entry in
+                    self.reverse.get(int(user), {}).items()
+                    if kind is None or key[0] == kind)
+
+    def rows(self):
+        """Yield every entry as a dict, ordered by object."""
+        for key in sorted(self.forward):
+            for user, (permission, granted_via) in sorted(
+                    self.forward[key].items()):
+                yield {'kind': key[0], 'id': key[1], 'user_id': user,
+                       'username': self.usernames[user],
+                       'permission': permission,
+                       'granted_via': granted_via}
+
+    def export(self, file):
+        """Write the entries as JSON lines to a path or text file object.
+
+        Returns the number of lines written.
+        """
+        count = 0
+        with contextlib.ExitStack() as stack:
+            if isinstance(file, str):
+                file = stack.enter_context(open(file, 'w'))
+            for row in self.rows():
+                file.write(json.dumps(row) + '\n')
+                count += 1
+        return count
+
+
+class Columns(object):
+    """The items of a collection in typed columns, for NumPy.
+
+    Items are added to compact column buffers while the pages are received,
+    the dicts are not kept. IDs and counts are integers (the smallest int64
+    if missing), times are seconds since the epoch (datetime64[s], NaT if
+    missing), references to users are user IDs (-1 if missing, their names
+    are in users()), and projects, tag sets, usernames and roles are codes
+    of categories (-1 if missing). The single tags of the items are in
+    tags(). Passwords, projects and users are supported.
+    """
+    int64_missing = -2 ** 63
+    # column, type and field of the items of each record class
+    specs = {
+        'Password': (
+            ('id', 'int', 'id'), ('project', 'category', 'project'),
+            ('tag_set', 'category', 'tags'),
+            ('username', 'category', 'username'),
+            ('archived', 'bool', 'archived'), ('locked', 'bool', 'locked'),
+            ('favorite', 'bool', 'favorite'),
+            ('external_sharing', 'bool', 'external_sharing'),
+            ('num_files', 'int', 'num_files'),
+            ('expiry_status', 'int', 'expiry_status'),
+            ('expiry_date', 'time', 'expiry_date'),
+            ('created_on', 'time', 'created_on'),
+            ('updated_on', 'time', 'updated_on'),
+            ('created_by', 'user', 'created_by'),
+            ('updated_by', 'user', 'updated_by')),
+        'Project': (
+            ('id', 'int', 'id'), ('parent_id', 'int', 'parent_id'),
+            ('tag_set', 'category', 'tags'),
+            ('archived', 'bool', 'archived'),
+            ('favorite', 'bool', 'favorite'),
+            ('num_files', 'int', 'num_files'),
+            ('num_passwords', 'int', 'num_passwords'),
+            ('managed_by', 'user', 'managed_by'),
+            ('created_on', 'time', 'created_on'),
+            ('updated_on', 'time', 'updated_on')),
+        'User': (
+            ('id', 'int', 'id'), ('role', 'category', 'role'),
+            ('is_active', 'bool', 'is_active'), ('is_ldap', 'bool', 'is_ldap'),
+            ('is_2fa_enabled', 'bool', 'is_2fa_enabled'),
+            ('num_groups', 'int', 'num_groups'),
+            ('last_login', 'time', 'last_login'),
+            ('created_on', 'time', 'created_on')),
+    }
+    typecodes = {'int': 'q', 'user': 'q', 'time': 'q', 'category': 'i',
+                 'bool': 'b'}
+    dtypes = {'int': 'i8', 'user': 'i8', 'time': 'M8[s]', 'category': 'i4',
+              'bool': '?'}
+
+    def __init__(self, client, path='passwords.json'):
+        if numpy is None:
+            raise TpmApi.ConfigError('numpy is required for columns')
+        self.client = synchronous(client, self)
+        self.path = path
+        record = record_type(client.normalize_path(path)[len(client.api):])
+        if record is None or record.__name__ not in self.specs:
+            raise TpmApi.ConfigError('No columns for {}'.format(path))
+        self.spec = self.specs[record.__name__]
+        self.buffers = dict((column, array.array(self.typecodes[kind]))
+                            for column, kind, _ in self.spec)
+        # category of each value, in the order the values were seen
+        self.codes = dict((column, {}) for column, kind, _ in self.spec
+                          if kind == 'category')
+        self.labels = dict((column, []) for column in self.codes)
+        # one row per tag of an item, as (row of the item, code of the tag)
+        self.tag_items = array.array('q')
+        self.tag_codes = array.array('i')
+        self.tag_names = {}
+        # names of the users referenced by user ID columns
+        self.user_names = {}
+
+    def __len__(self):
+        return len(self.buffers['id'])
+
+    def load(self):
+        """Request the collection and add all items, return self."""
+        for item in self.client.get_collection(self.path):
+            self.add(item)
+        return self
+
+    def category(self, column, value, label):
+        """Return the code of a value of a category column."""
+        codes = self.codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+            self.labels[column].append(label)
+        return code
+
+    @staticmethod
+    def epoch(value):
+        """Return the seconds since the epoch of a time or date of the API."""
+        if len(value) == len('2016-09-07'):
+            value += ' 00:00:00'
+        return calendar.timegm(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
+
+    def add(self, item):
+        """Add one item of the collection.
+
+        The whole row is converted first, an item with an invalid value
+        raises before anything is stored.
+        """
+        row = len(self)
+        values, tags, users = [], [], {}
+        for column, kind, field in self.spec:
+            value = item.get(field)
+            if kind == 'int':
+                value = self.int64_missing if value is None else int(value)
+            elif kind == 'bool':
+                value = 1 if value else 0
+            elif kind == 'time':
+                value = self.epoch(value) if value else self.int64_missing
+            elif kind == 'user':
+                if value:
+                    ID = int(value['id'])
+                    users[ID] = value.get('name') or value.get('username', '')
+                    value = ID
+                else:
+                    value = -1
+            # categories as (value, label), coded once the row is valid
+            elif field == 'project':
+                value = (int(value['id']), value.get('name', ''))\
+                    if value else None
+            elif field == 'tags':
+                tags = sorted(set(tag.strip().lower() for tag in
+                                  (value or '').split(',') if tag.strip()))
+                value = (','.join(tags),) * 2 if tags else None
+            else:
+                value = (value, value) if value is not None else None
+            values.append(value)
+        for (column, kind, _), value in zip(self.spec, values):
+            if kind == 'category':
+                value = self.category(column, *value) if value else -1
+            self.buffers[column].append(value)
+        for tag in tags:
+            self.tag_items.append(row)
+            self.tag_codes.append(
+                self.tag_names.setdefault(tag, len(self.tag_names)))
+        self.user_names.update(users)
+
+    def to_array(self):
+        """Return the items as a NumPy structured array."""
+        dtype = [(column, self.dtypes[kind]) for column, kind, _ in self.spec]
+        items = numpy.empty(len(self), dtype=dtype)
+        for column, kind, _ in self.spec:
+            values = numpy.frombuffer(self.buffers[column],
+                                      dtype=self.buffers[column].typecode)
+            if kind == 'time':
+                values = values.view('M8[s]')
+            items[column] = values
+        return items
+
+    def categories(self, column):
+        """Return the labels of the codes of a category column.
+
+        'tag' returns the labels of the single tags of tags().
+        """
+        if column == 'tag':
+            return numpy.array(list(self.tag_names), dtype=str)
+        return numpy.array(self.labels[column], dtype=str)
+
+    def users(self):
+        """Return a structured array of the IDs and names of the users."""
+        IDs = sorted(self.user_names)
+        names = [self.user_names[ID] for ID in IDs]
+        width = max([1] + [len(name) for name in names])
+        users = numpy.empty(len(IDs), dtype=[('id', 'i8'),
+                                             ('name', 'U{}'.format(width))])
+        users['id'] = IDs
+        users['name'] = names
+        return users
+
+    def tags(self):
+        """Return a structured array with one row per tag of an item."""
+        tags = numpy.empty(len(self.tag_items),
+                           dtype=[('item', 'i8'), ('tag', 'i4')])
+        tags['item'] = numpy.frombuffer(self.tag_items, dtype='q')
+        tags['tag'] = numpy.frombuffer(self.tag_codes, dtype='i')
+        return tags
+
+    def save(self, file):
+        """Save the items, tags and categories as a compressed .npz file.
+
+        The arrays are 'items', 'tags', 'tag_categories', 'users', for every
+        category column '<column>_categories' and for passwords the IDs of the
+        project categories as 'project_ids'.
+        """
+        arrays = {'items': self.to_array(), 'tags': self.tags(),
+                  'tag_categories': self.categories('tag'),
+                  'users': self.users()}
+        for column in self.codes:
+            arrays[column + '_categories'] = self.categories(column)
+        if 'project' in self.codes:
+            arrays['project_ids'] = numpy.array(list(self.codes['project']),
+                                                dtype='i8')
+        numpy.savez_compressed(file, **arrays)
+
+
+def prefetch_pages(pages, depth, context=None):
+    """Consume pages in a background thread, up to depth pages ahead.
+
+    Pages are yielded in their original order, exceptions are raised when the
+    page that failed is reached. context can wrap the function run by the
+    background thread.
+    """
+    done = object()
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((None, e))
+
+    if context is not None:
+        worker = context(worker)
+    thread = threading.Thread(target=worker, name='tpm-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if error is not None:
+                raise error
+            if page is done:
+                return
+            yield page
+    finally:
+        stop.set()
+
+
 class TpmApi(object):
     """Settings needed for the connection to Team Password Manager."""
     class ConfigError(Exception):
@@ -60,6 +1952,13 @@ class TpmApi(object):
         def __str__(self):
             return repr(self.value)
 
+    # the API functions return awaitables instead of results
+    asynchronous = False
+    # resources whose GET requests may be shared with coalesce, not e.g.
+    # generate_password, which has to answer every caller differently
+    coalesced_resources = ('projects', 'passwords', 'my_passwords', 'users',
+                           'groups', 'files', 'version')
+
     def __init__(self, api, base_url, kwargs):
         """init thing."""
         # Check if API version is not bullshit
@@ -91,9 +1990,10 @@ class TpmApi(object):
         else:
             raise self.ConfigError('Invalid URL: {}'.format(base_url))
         # set headers
-        self.headers = {'Content-Type': 'application/json; charset=utf-8',
-                        'User-Agent': 'tpm.py/' + __version__
-                        }
+        # base headers are read only, per request headers are added to a copy
+        self.headers = types.MappingProxyType(
+            {'Content-Type': 'application/json; charset=utf-8',
+             'User-Agent': 'tpm.py/' + __version__})
         log.debug('Set header to {}'.format(self.headers))
         # check kwargs for either keys or user credentials
         self.private_key = False
@@ -101,6 +2001,36 @@ class TpmApi(object):
         self.username = False
         self.password = False
         self.unlock_reason = False
+        # connection pool settings
+        self.pool_connections = 10
+        self.pool_maxsize = 10
+        self.keep_alive = True
+        self.max_idle = False
+        # number of collection pages to request ahead
+        self.prefetch = 0
+        # number of workers to request collection pages concurrently
+        self.page_workers = 0
+        # number of workers for bulk functions, defaults to the pool size
+        self.bulk_workers = 0
+        self.retry = Retry()
+        self.rate_limiter = None
+        self.concurrency = None
+        self.circuit_breaker = None
+        self.connect_timeout = 10
+        self.read_timeout = 60
+        self.hedging = None
+        self.cache = None
+        self.coalesce = False
+        # decode the items of collection pages while they are received
+        self.stream = False
+        self.chunk_size = 65536
+        self.codec = None
+        # return collections that request their pages when needed
+        self.lazy = False
+        # return items as Record objects instead of dicts
+        self.records = False
+        # share equal nested objects and strings between collection items
+        self.dedupe = False
         for key in kwargs:
             if key == 'private_key':
                 self.private_key = kwargs[key]
@@ -112,6 +2042,50 @@ class TpmApi(object):
                 self.password = kwargs[key]
             elif key == 'unlock_reason':
                 self.unlock_reason = kwargs[key]
+            elif key == 'pool_connections':
+                self.pool_connections = kwargs[key]
+            elif key == 'pool_maxsize':
+                self.pool_maxsize = kwargs[key]
+            elif key == 'keep_alive':
+                self.keep_alive = kwargs[key]
+            elif key == 'max_idle':
+                self.max_idle = kwargs[key]
+            elif key == 'prefetch':
+                self.prefetch = kwargs[key]
+            elif key == 'page_workers':
+                self.page_workers = kwargs[key]
+            elif key == 'bulk_workers':
+                self.bulk_workers = kwargs[key]
+            elif key == 'retry':
+                self.retry = kwargs[key]
+            elif key == 'rate_limiter':
+                self.rate_limiter = kwargs[key]
+            elif key == 'concurrency':
+                self.concurrency = kwargs[key]
+            elif key == 'circuit_breaker':
+                self.circuit_breaker = kwargs[key]
+            elif key == 'connect_timeout':
+                self.connect_timeout = kwargs[key]
+            elif key == 'read_timeout':
+                self.read_timeout = kwargs[key]
+            elif key == 'hedging':
+                self.hedging = kwargs[key]
+            elif key == 'cache':
+                self.cache = kwargs[key]
+            elif key == 'coalesce':
+                self.coalesce = kwargs[key]
+            elif key == 'stream':
+                self.stream = kwargs[key]
+            elif key == 'chunk_size':
+                self.chunk_size = kwargs[key]
+            elif key == 'codec':
+                self.codec = kwargs[key]
+            elif key == 'lazy':
+                self.lazy = kwargs[key]
+            elif key == 'records':
+                self.records = kwargs[key]
+            elif key == 'dedupe':
+                self.dedupe = kwargs[key]
         if self.private_key is not False and self.public_key is not False and\
                 self.username is False and self.password is False:
             log.debug('Using Private/Public Key authentication.')
@@ -121,10 +2095,84 @@ class TpmApi(object):
         else:
             raise self.ConfigError('No authentication specified'
                                    ' (user/password or private/public key)')
-
-
-    def request(self, path, action, data=''):
-        """To make a request to the API."""
+        if not isinstance(self.retry, Retry):
+            self.retry = Retry(retries=int(self.retry or 0))
+        if self.cache is True:
+            self.cache = ResponseCache()
+        elif not self.cache:
+            self.cache = None
+        # a name of a library or any object with dumps and loads
+        if not hasattr(self.codec, 'loads'):
+            try:
+                self.codec = JsonCodec(self.codec)
+            except ValueError as e:
+                raise self.ConfigError(str(e))
+        log.debug('Using JSON codec {}'.format(
+            getattr(self.codec, 'name', self.codec)))
+        self.session = None
+        self.last_used = 0
+        self.session_lock = threading.Lock()
+        self.local = threading.local()
+        # counters of requests, retries and errors
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+        self.hedge_executor = None
+        self.flights = SingleFlight()
+        self.listeners = ()
+
+    @property
+    def req(self):
+        """The last response received by the current thread."""
+        return getattr(self.local, 'req', None)
+
+    @req.setter
+    def req(self, response):
+        self.local.req = response
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_session(self):
+        """Return the pooled session, (re)creating it if needed."""
+        with self.session_lock:
+            now = time.time()
+            if self.session is not None and self.max_idle and\
+                    now - self.last_used > self.max_idle:
+                log.debug('Session idle for more than {}s, reconnecting.'
+                          .format(self.max_idle))
+                self.session.close()
+                self.session = None
+            if self.session is None:
+                log.debug('Create session with pool size {}/{}'.format(
+                    self.pool_connections, self.pool_maxsize))
+                self.session = requests.Session()
+                self.session.verify = False
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize)
+                self.session.mount('https://', adapter)
+                self.session.mount('http://', adapter)
+                if not self.keep_alive:
+                    self.session.headers['Connection'] = 'close'
+            self.last_used = now
+            return self.session
+
+    def close(self):
+        """Close all pooled connections."""
+        with self.session_lock:
+            if self.hedge_executor is not None:
+                self.hedge_executor.shutdown(wait=False)
+                self.hedge_executor = None
+            if self.session is not None:
+                log.debug('Close session.')
+                self.session.close()
+                self.session = None
+
+    def normalize_path(self, path):
+        """Return the path of a request relative to the base URL."""
         # Check if the path includes URL or not.
         head = self.base_url
         if path.startswith(head):
@@ -132,78 +2180,509 @@ class TpmApi(object):
             path = quote_plus(path, safe='/')
         if not path.startswith(self.api):
             path = self.api + path
+        return path
+
+    def prepare_request(self, path, data='', unlock_reason=None):
+        """Return URL, encoded data, headers and credentials of a request.
+
+        Nothing is stored on the instance, so requests can be prepared by
+        several threads at the same time.
+        """
+        head = self.base_url
+        path = self.normalize_path(path)
         log.debug('Using path {}'.format(path))
 
         # If we have data, convert to JSON
         if data:
-            data = json.dumps(data)
-            log.debug('Data to sent: {}'.format(data))
+            data = self.codec.dumps(data)
+            log.debug('Data to sent: {}'.format(data.decode('utf-8')))
+        else:
+            data = b''
+        headers = dict(self.headers)
+        credentials = None
         # In case of key authentication
         if self.private_key and self.public_key:
             timestamp = str(int(time.time()))
             log.debug('Using timestamp: {}'.format(timestamp))
-            unhashed = path + timestamp + str(data)
-            log.debug('Using message: {}'.format(unhashed))
-            self.hash = hmac.new(str.encode(self.private_key),
-                                 msg=unhashed.encode('utf-8'),
-                                 digestmod=hashlib.sha256).hexdigest()
-            log.debug('Authenticating with hash: {}'.format(self.hash))
-            self.headers['X-Public-Key'] = self.public_key
-            self.headers['X-Request-Hash'] = self.hash
-            self.headers['X-Request-Timestamp'] = timestamp
-            auth = False
+            # sign the same bytes that are sent
+            unhashed = (path + timestamp).encode('utf-8') + data
+            log.debug('Using message: {}'.format(unhashed.decode('utf-8')))
+            request_hash = hmac.new(str.encode(self.private_key),
+                                    msg=unhashed,
+                                    digestmod=hashlib.sha256).hexdigest()
+            log.debug('Authenticating with hash: {}'.format(request_hash))
+            headers['X-Public-Key'] = self.public_key
+            headers['X-Request-Hash'] = request_hash
+            headers['X-Request-Timestamp'] = timestamp
         # In case of user credentials authentication
         elif self.username and self.password:
-            auth = requests.auth.HTTPBasicAuth(self.username, self.password)
+            credentials = (self.username, self.password)
         # Set unlock reason
-        if self.unlock_reason:
-            self.headers['X-Unlock-Reason'] = self.unlock_reason
-            log.info('Unlock Reason: {}'.format(self.unlock_reason))
-        url = head + path
-        # Try API request and handle Exceptions
+        if not unlock_reason:
+            unlock_reason = self.unlock_reason
+        if unlock_reason:
+            headers['X-Unlock-Reason'] = unlock_reason
+            log.info('Unlock Reason: {}'.format(unlock_reason))
+        return head + path, data, headers, credentials
+
+    def parse_response(self, url, status_code, content, response_url):
+        """Decode the JSON body of a response and check it for errors."""
+        if content == b'':
+            log.debug('No result returned.')
+            return None
         try:
-            if action == 'get':
-                log.debug('GET request {}'.format(url))
-                self.req = requests.get(url, headers=self.headers, auth=auth,
-                                        verify=False)
-            elif action == 'post':
-                log.debug('POST request {}'.format(url))
-                self.req = requests.post(url, headers=self.headers, auth=auth,
-                                         verify=False, data=data)
-            elif action == 'put':
-                log.debug('PUT request {}'.format(url))
-                self.req = requests.put(url, headers=self.headers,
-                                        auth=auth, verify=False,
-                                        data=data)
-            elif action == 'delete':
-                log.debug('DELETE request {}'.format(url))
-                self.req = requests.delete(url, headers=self.headers,
-                                           verify=False, auth=auth)
-
-            if self.req.content == b'':
-                result = None
-                log.debug('No result returned.')
-            else:
-                result = self.req.json()
-                if 'error' in result and result['error']:
-                    raise TPMException(result['message'])
-
-        except requests.exceptions.RequestException as e:
-            log.critical("Connection error for " + str(e))
-            raise TPMException("Connection error for " + str(e))
-
+            try:
+                result = self.codec.loads(content)
+            except ValueError:
+                # the standard library is more lenient, and its messages are
+                # the same whatever the codec
+                result = json.loads(content)
         except ValueError as e:
-            if self.req.status_code == 403:
+            if status_code == 403:
                 log.warning(url + " forbidden")
                 raise TPMException(url + " forbidden")
-            elif self.req.status_code == 404:
+            elif status_code == 404:
                 log.warning(url + " forbidden")
                 raise TPMException(url + " not found")
             else:
-                message = ('{}: {} {}'.format(e, self.req.url, self.req.text))
+                message = ('{}: {} {}'.format(
+                    e, response_url, content.decode('utf-8', 'replace')))
                 log.debug(message)
                 raise ValueError(message)
+        if 'error' in result and result['error']:
+            raise TPMException(result['message'])
+        return result
 
+    def record(self, name, value=1):
+        """Add value to a counter in stats."""
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def throttled(self, delay):
+        """Count the time a request waited for the rate limiter."""
+        if delay:
+            log.debug('Rate limited for {:.3f}s'.format(delay))
+            self.record('rate_limited')
+            self.record('rate_limited_seconds', delay)
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """Limit the time of all requests made within the context.
+
+        The deadline is checked before each request, page and retry, and
+        request timeouts are cut to the time left. It also applies to the
+        bulk functions and the pages requested in the background, as long as
+        they are consumed within the context. Nested deadlines can only
+        shorten the time left.
+        """
+        previous = self.current_deadline()
+        deadline = Deadline(seconds)
+        if previous is not None and previous.expires < deadline.expires:
+            deadline = previous
+        self.local.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            self.local.deadline = previous
+
+    def current_deadline(self):
+        """Return the deadline of the current thread, if any."""
+        return getattr(self.local, 'deadline', None)
+
+    def bind_deadline(self, function):
+        """Wrap function to run with the deadline of the current thread."""
+        deadline = self.current_deadline()
+        if deadline is None:
+            return function
+
+        @functools.wraps(function)
+        def call(*args, **kwargs):
+            previous = self.current_deadline()
+            self.local.deadline = deadline
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.deadline = previous
+        return call
+
+    def timeout(self):
+        """Return the (connect, read) timeout for the next request.
+
+        Raises DeadlineExceeded if no time is left.
+        """
+        connect, read = self.connect_timeout, self.read_timeout
+        deadline = self.current_deadline()
+        if deadline is not None:
+            remaining = deadline.remaining()
+            if not remaining:
+                # requests rejects a timeout of 0
+                deadline.check('before a request')
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        return connect, read
+
+    def backoff(self, action, url, attempt, reason, retry_after=None):
+        """Log, count and wait before a retry."""
+        delay = self.retry.delay(attempt, retry_after)
+        deadline = self.current_deadline()
+        if deadline is not None and delay >= deadline.remaining():
+            raise DeadlineExceeded('Deadline of {}s exceeded before retry '
+                                   'of {}: {}'.format(deadline.seconds, url,
+                                                      reason))
+        log.warning('Retry {} {} in {:.2f}s ({}/{}): {}'.format(
+            action.upper(), url, delay, attempt + 1, self.retry.retries, reason))
+        self.record('retries')
+        self.record('retries_' + action)
+        time.sleep(delay)
+
+    def transmit(self, action, url, headers, auth, body, stream=False):
+        """Send one HTTP request over the pooled session.
+
+        With stream, the body of a GET response is not read yet.
+        """
+        session = self.get_session()
+        timeout = self.timeout()
+        if action == 'get':
+            log.debug('GET request {}'.format(url))
+            return session.get(url, headers=headers, auth=auth, verify=False,
+                               timeout=timeout, stream=stream)
+        elif action == 'post':
+            log.debug('POST request {}'.format(url))
+            return session.post(url, headers=headers, auth=auth,
+                                verify=False, data=body, timeout=timeout)
+        elif action == 'put':
+            log.debug('PUT request {}'.format(url))
+            return session.put(url, headers=headers, auth=auth, verify=False,
+                               data=body, timeout=timeout)
+        elif action == 'delete':
+            log.debug('DELETE request {}'.format(url))
+            return session.delete(url, headers=headers, auth=auth,
+                                  verify=False, timeout=timeout)
+
+    def transmit_hedged(self, action, url, headers, auth, body, stream=False):
+        """Send a GET request, and a second one if the first is slow.
+
+        The first response wins, the other one is dropped when it arrives.
+        The second request is skipped unless admit_hedge lets it through at
+        once. The hedging delay is learned from the first requests only.
+        """
+        delay = self.hedging.delay()
+        start = time.monotonic()
+        if action != 'get' or delay is None:
+            response = self.transmit(action, url, headers, auth, body, stream)
+            if action == 'get':
+                self.hedging.observe(time.monotonic() - start)
+            return response
+        with self.session_lock:
+            if self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(
+                    max_workers=2 * self.pool_maxsize,
+                    thread_name_prefix='tpm-hedge')
+        transmit = self.bind_deadline(self.transmit)
+        primary = self.hedge_executor.submit(transmit, action, url, headers,
+                                             auth, body, stream)
+
+        def observe_primary(future):
+            if future.exception() is None:
+                self.hedging.observe(time.monotonic() - start)
+
+        primary.add_done_callback(observe_primary)
+        pending = [primary]
+        done, _ = wait(pending, timeout=delay)
+        if not done:
+            if self.admit_hedge():
+                log.debug('No response after {:.3f}s, hedge GET {}'.format(
+                    delay, url))
+                self.record('hedges')
+                pending.append(self.submit_hedge(primary, transmit, action,
+                                                 url, headers, auth, body,
+                                                 stream))
+            else:
+                self.record('hedges_skipped')
+
+        def drop(future):
+            if future.exception() is None:
+                future.result().close()
+
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    continue
+                if future is not primary:
+                    self.record('hedges_won')
+                for other in pending:
+                    # an admitted request is not aborted, drop its response
+                    other.add_done_callback(drop)
+                return response
+        raise error
+
+    def admit_hedge(self):
+        """Check if a hedge request may be sent right away.
+
+        A hedge never waits: it needs a free concurrency slot, a rate limiter
+        token and the consent of the circuit breaker at once. It is counted
+        as a request when admitted.
+        """
+        if self.concurrency is not None and\
+                not self.concurrency.try_acquire():
+            return False
+        if (self.rate_limiter is not None and
+                not self.rate_limiter.try_acquire('get')) or\
+                (self.circuit_breaker is not None and
+                 not self.circuit_breaker.allow()):
+            if self.concurrency is not None:
+                self.concurrency.release()
+            return False
+        self.record('requests')
+        return True
+
+    def submit_hedge(self, primary, transmit, *args):
+        """Send an admitted hedge request in the background.
+
+        Its outcome is reported like that of any request. Its slot is given
+        back once both requests are done, the caller gives back the other one
+        when the first has answered.
+        """
+        start = time.monotonic()
+        hedge = self.hedge_executor.submit(transmit, *args)
+
+        def observe(future):
+            error = future.exception()
+            if error is not None and not isinstance(
+                    error, requests.exceptions.RequestException):
+                self.abandon()
+                return
+            self.observe(start, error is not None or
+                         future.result().status_code >= 500 or
+                         future.result().status_code == 429,
+                         self.latency_key(*args[:2]))
+
+        def release(future):
+            if self.concurrency is not None:
+                self.concurrency.release()
+
+        hedge.add_done_callback(observe)
+        hedge.add_done_callback(lambda _: primary.add_done_callback(release))
+        return hedge
+
+    def check_circuit(self, url):
+        """Fail fast if the circuit breaker is open."""
+        if self.circuit_breaker is not None and\
+                not self.circuit_breaker.allow():
+            self.record('circuit_open')
+            log.warning('Circuit breaker open, skip {}'.format(url))
+            raise CircuitOpenError('Circuit breaker open for ' + url)
+
+    def latency_key(self, action, path):
+        """Return the kind of a request, whose latencies are comparable.
+
+        IDs, page numbers and search strings are left out, e.g.
+        'get passwords/page/#.json' for any page of the passwords.
+        """
+        resource = self.normalize_path(path)[len(self.api):].split('?', 1)[0]
+        resource = re.sub(r'/search/.*', '/search', resource)
+        return action + ' ' + re.sub(r'\d+', '#', resource)
+
+    def abandon(self):
+        """Report a request that ended without a response from the server.
+
+        Errors of the client say nothing about the server, only the probe
+        slot of the circuit breaker is given back.
+        """
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.release()
+
+    def observe(self, start, failed, key=None):
+        """Report the latency and outcome of a request to the limiters."""
+        if self.concurrency is not None:
+            self.concurrency.observe(time.monotonic() - start, failed, key)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(not failed)
+
+    def send(self, path, action, data='', unlock_reason=None):
+        """Make a request to the API, return the result and the response.
+
+        With a cache, GET responses are served from it while fresh and
+        other requests invalidate the responses they may have changed.
+        With coalesce, concurrent identical GET requests of the
+        coalesced_resources share one request.
+        Listeners are told about every successful change.
+        """
+        if self.cache is None and not self.coalesce and\
+                (action == 'get' or not self.listeners):
+            return self.send_request(path, action, data, unlock_reason)
+        path = self.normalize_path(path)
+        resource = path[len(self.api):]
+        if action != 'get':
+            try:
+                result, response = self.send_request(path, action, data,
+                                                     unlock_reason)
+            finally:
+                if self.cache is not None:
+                    self.cache.invalidate(resource)
+            self.notify(action, resource, data, result)
+            return result, response
+        if self.cache is not None:
+            # a cache may be shared, other users must not see these responses
+            key = (self.public_key or self.username, self.base_url + path)
+            generation = self.cache.generation
+            response = self.cache.get(key)
+            if response is not None:
+                log.debug('Cached response for {}'.format(path))
+                return self.decode_again(path, response), response
+        if self.coalesce and resource.split('/', 1)[0].split('.', 1)[0] in\
+                self.coalesced_resources:
+            (result, response), leader = self.coalesced(path)
+            if not leader:
+                result = self.decode_again(path, response)
+        else:
+            result, response = self.send_request(path, action)
+        if self.cache is not None:
+            self.cache.set(key, resource, response, generation)
+        return result, response
+
+    def add_listener(self, listener):
+        """Call listener(action, resource, data, result) after each change.
+
+        resource is the path of a successful POST, PUT or DELETE request
+        relative to the API, e.g. 'projects/4/change_parent.json'.
+        """
+        with self.session_lock:
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """Stop calling listener after changes."""
+        with self.session_lock:
+            self.listeners = tuple(other for other in self.listeners
+                                   if other != listener)
+
+    def notify(self, action, resource, data, result):
+        """Tell the listeners about a change, their errors are only logged."""
+        for listener in self.listeners:
+            try:
+                listener(action, resource, data, result)
+            except Exception as e:
+                log.warning('Listener failed after {} {}: {}'.format(
+                    action.upper(), resource, e))
+
+    def coalesced(self, path):
+        """GET path, or wait for the identical request already running."""
+        deadline = self.current_deadline()
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            value, leader = self.flights.do(
+                path, lambda: self.send_request(path, 'get'), timeout)
+        except FutureTimeoutError:
+            raise DeadlineExceeded('Deadline of {}s exceeded waiting for '
+                                   '{}'.format(deadline.seconds, path))
+        if not leader:
+            log.debug('Shared response for {}'.format(path))
+            self.record('coalesced')
+        return value, leader
+
+    def decode_again(self, path, response):
+        """Decode a shared response, so callers do not share the result."""
+        return self.parse_response(path, response.status_code,
+                                   response.content, response.url)
+
+    def send_request(self, path, action, data='', unlock_reason=None,
+                     stream=False):
+        """Make a request to the API, return the result and the response.
+
+        With stream, a successful response is returned without reading its
+        body and the result is None.
+        """
+        attempt = 0
+        key = self.latency_key(action, path)
+        while True:
+            # sign again for every attempt, the timestamp is part of the hash
+            url, body, headers, credentials = self.prepare_request(
+                path, data, unlock_reason)
+            auth = False
+            if credentials:
+                auth = requests.auth.HTTPBasicAuth(*credentials)
+            deadline = self.current_deadline()
+            if deadline is not None:
+                deadline.check('before {} {}'.format(action.upper(), url))
+            self.check_circuit(url)
+            start = time.monotonic()
+            # Try API request and handle Exceptions
+            try:
+                if self.rate_limiter is not None:
+                    delay = self.rate_limiter.acquire(
+                        action, deadline and deadline.remaining())
+                    if delay is None:
+                        raise DeadlineExceeded(
+                            'Deadline of {}s exceeded waiting for the rate '
+                            'limiter before {} {}'.format(
+                                deadline.seconds, action.upper(), url))
+                    self.throttled(delay)
+                # the slot is held for the HTTP request only, never while
+                # waiting for a retry or for the caller, which may hold one
+                if self.concurrency is not None and\
+                        not self.concurrency.acquire(
+                            deadline and deadline.remaining()):
+                    raise DeadlineExceeded(
+                        'Deadline of {}s exceeded waiting for a concurrency '
+                        'slot before {} {}'.format(
+                            deadline.seconds, action.upper(), url))
+                self.record('requests')
+                start = time.monotonic()
+                try:
+                    if self.hedging is not None:
+                        response = self.transmit_hedged(action, url, headers,
+                                                        auth, body, stream)
+                    else:
+                        response = self.transmit(action, url, headers, auth,
+                                                 body, stream)
+                finally:
+                    if self.concurrency is not None:
+                        self.concurrency.release()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                self.observe(start, True)
+                if self.retry.allowed(action, attempt):
+                    self.backoff(action, url, attempt, e)
+                    attempt += 1
+                    continue
+                self.record('errors')
+                log.critical("Connection error for " + str(e))
+                raise TPMException("Connection error for " + str(e))
+            except requests.exceptions.RequestException as e:
+                self.observe(start, True)
+                self.record('errors')
+                log.critical("Connection error for " + str(e))
+                raise TPMException("Connection error for " + str(e))
+            except BaseException:
+                # e.g. DeadlineExceeded or KeyboardInterrupt, a half open
+                # breaker must not wait for the probe slot forever
+                self.abandon()
+                raise
+            self.observe(start, response.status_code >= 500 or
+                         response.status_code == 429, key)
+            if response.status_code in self.retry.statuses and\
+                    self.retry.allowed(action, attempt):
+                response.close()
+                self.backoff(action, url, attempt, response.status_code,
+                             response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+            break
+
+        if stream and response.status_code == 200:
+            return None, response
+        result = self.parse_response(url, response.status_code,
+                                     response.content, response.url)
+        return result, response
+
+    def request(self, path, action, data='', unlock_reason=None):
+        """To make a request to the API."""
+        result, self.req = self.send(path, action, data, unlock_reason)
         return result
 
     def post(self, path, data=''):
@@ -212,35 +2691,279 @@ class TpmApi(object):
 
     def get(self, path):
         """For get based requests."""
-        return self.request(path, 'get')
+        return self.to_record(path, self.request(path, 'get'))
 
-    def put(self, path, data=''):
+    def put(self, path, data='', unlock_reason=None):
         """For put based requests."""
-        return self.request(path, 'put', data)
+        return self.request(path, 'put', data, unlock_reason)
 
     def delete(self, path):
         """For delete based requests."""
         self.request(path, 'delete')
 
-    def get_collection(self, path):
-        """To get pagewise data."""
-        while True:
-            items = self.get(path)
-            req = self.req
+    def next_page(self, response):
+        """Return the URL of the next page linked in a response, if any."""
+        link = response.links.get('next')
+        if link and link.get('rel') == 'next':
+            return str(link['url'])
+        return None
+
+    def get_pages(self, path):
+        """To get all pages of a collection, one list of items per page."""
+        while path:
+            items, response = self.send(path, 'get')
+            yield items
+            path = self.next_page(response)
+
+    def get_pages_streamed(self, path):
+        """To get all pages of a collection, one iterator of items per page.
+
+        The items of a page are decoded while its body is received, the page
+        has to be consumed before the next one is requested.
+        """
+        while path:
+            _, response = self.send_request(path, 'get', stream=True)
+            yield self.stream_items(response)
+            path = self.next_page(response)
+
+    def stream_items(self, response):
+        """Yield the items of a streamed response as they are decoded.
+
+        A JSON object instead of an array, e.g. an error of the API, is read
+        whole and checked by parse_response, as without stream.
+        """
+        chunks = response.iter_content(chunk_size=self.chunk_size)
+        try:
+            head = b''
+            for chunk in chunks:
+                head += chunk
+                if head.strip():
+                    break
+            if head.lstrip().startswith(b'{'):
+                content = head + b''.join(chunks)
+                for item in self.parse_response(response.url,
+                                                response.status_code,
+                                                content, response.url):
+                    yield item
+                return
+            try:
+                for item in iter_json_array(itertools.chain((head,), chunks)):
+                    yield item
+            except ValueError as e:
+                message = '{}: {}'.format(e, response.url)
+                log.debug(message)
+                raise ValueError(message)
+        finally:
+            response.close()
+
+    def page_path(self, path, page):
+        """Return the path of a page of a collection."""
+        return '{}/page/{}.json'.format(path[:-len('.json')], page)
+
+    def count_path(self, path):
+        """Return the path of the count of a collection."""
+        return '{}/count.json'.format(path[:-len('.json')])
+
+    def get_pages_parallel(self, path, workers):
+        """To get all pages of a collection concurrently.
+
+        The number of pages is read from the count of the collection, the
+        pages are then requested by a pool of workers and returned in order.
+        Items already returned by an earlier page are skipped, in case data
+        shifted during the crawl. Falls back to following the next links if
+        the collection has no count.
+        """
+        try:
+            count = self.get(self.count_path(path))
+            num_pages = int(count.get('num_pages'))
+        except (TPMException, ValueError, TypeError, AttributeError) as e:
+            log.debug('No count for {} ({}), get pages one by one.'
+                      .format(path, e))
+            for items in self.get_pages(path):
+                yield items
+            return
+        log.debug('Get {} pages of {} with {} workers'
+                  .format(num_pages, path, workers))
+        seen = set()
+
+        def unseen(items):
             for item in items:
+                ID = item.get('id') if isinstance(item, dict) else None
+                if ID is not None:
+                    if ID in seen:
+                        continue
+                    seen.add(ID)
                 yield item
-            if req.links and req.links['next'] and\
-                    req.links['next']['rel'] == 'next':
-                path = req.links['next']['url']
-            else:
-                break
+
+        fetch = self.bind_deadline(self.send)
+        pending = collections.deque()
+        response = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                page = 1
+                while pending or page <= num_pages:
+                    # keep the workers busy, but not too far ahead
+                    while page <= num_pages and len(pending) < 2 * workers:
+                        pending.append(executor.submit(
+                            fetch, self.page_path(path, page), 'get'))
+                        page += 1
+                    items, response = pending.popleft().result()
+                    yield list(unseen(items))
+            finally:
+                for future in pending:
+                    future.cancel()
+        # Items added during the crawl can spill over to additional pages.
+        next_path = response is not None and self.next_page(response)
+        if next_path:
+            for items in self.get_pages(next_path):
+                yield list(unseen(items))
+
+    def get_collection(self, path, prefetch=None, workers=None, stream=None):
+        """To get pagewise data.
+
+        With prefetch the next pages are requested in the background while
+        the current one is consumed, at most prefetch pages ahead. With
+        workers the pages are requested concurrently, based on the count of
+        the collection. With stream, pages requested one by one are decoded
+        item by item while they are received. With dedupe, equal nested
+        objects and strings are shared between the items.
+        """
+        if prefetch is None:
+            prefetch = self.prefetch
+        if workers is None:
+            workers = self.page_workers
+        if stream is None:
+            stream = self.stream
+        if workers:
+            pages = self.get_pages_parallel(path, workers)
+        elif stream and not prefetch:
+            pages = self.get_pages_streamed(path)
+        else:
+            pages = self.get_pages(path)
+            if prefetch:
+                pages = prefetch_pages(pages, prefetch, self.bind_deadline)
+        interner = Interner() if self.dedupe else None
+        for items in pages:
+            for item in items:
+                yield item if interner is None else interner(item)
 
     def collection(self, path):
-        """To return all items generated by get collection."""
+        """To return all items generated by get collection.
+
+        With lazy a Collection is returned instead of a list, which requests
+        the pages when they are needed.
+        """
+        if self.lazy:
+            return Collection(self, path)
         data = []
         for item in self.get_collection(path):
             data.append(item)
-        return data
+        return self.to_record(path, data)
+
+    def to_record(self, path, result):
+        """Return an item, or a list of items, as records if enabled."""
+        if not self.records or not isinstance(result, (dict, list)):
+            return result
+        record = record_type(self.normalize_path(path)[len(self.api):])
+        if record is None:
+            return result
+        if isinstance(result, dict):
+            return record(result)
+        return [record(item) if isinstance(item, dict) else item
+                for item in result]
+
+    def bulk(self, function, IDs, workers=None):
+        """Call function for each ID concurrently.
+
+        Yields (ID, result) pairs as the calls complete. If a call fails, the
+        exception is returned instead of the result and the others go on.
+        """
+        if not workers:
+            workers = self.bulk_workers or self.pool_maxsize
+            if self.concurrency is not None:
+                workers = self.concurrency.maximum
+        name = getattr(function, '__name__', repr(function))
+        function = self.bind_deadline(function)
+        IDs = iter(IDs)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # keep the workers busy, but do not read all IDs at once
+                    for ID in itertools.islice(IDs, 2 * workers - len(pending)):
+                        pending[executor.submit(function, ID)] = ID
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ID = pending.pop(future)
+                        try:
+                            yield ID, future.result()
+                        except Exception as e:
+                            log.warning('{} failed for {}: {}'.format(
+                                name, ID, e))
+                            yield ID, e
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def run_batch(self, operations, workers=None, done=()):
+        """Run a stream of operations concurrently.
+
+        Every operation is a dict with the name of a function of this client
+        and its arguments, e.g.
+        {'key': 'web-1', 'function': 'create_password', 'args': [data]}.
+        The key defaults to the position in the stream. For each operation a
+        report is yielded as it completes:
+        {'key': ..., 'function': ..., 'ok': True, 'result': NewID,
+         'error': None, 'elapsed': 0.12}.
+        Reports can be stored as JSON lines; to resume a batch pass the keys
+        of the successful reports as done and they are skipped.
+        """
+        done = set(done)
+
+        def pending():
+            for position, operation in enumerate(operations):
+                key = operation.get('key', position)
+                if key in done:
+                    log.debug('Skip finished operation {}'.format(key))
+                    continue
+                yield dict(operation, key=key)
+
+        def run(operation):
+            name = operation.get('function', '')
+            report = {'key': operation['key'], 'function': name, 'ok': False,
+                      'result': None, 'error': None}
+            start = time.time()
+            try:
+                function = getattr(self, name, None)
+                if name.startswith('_') or not callable(function):
+                    raise TPMException('Unknown function: {}'.format(name))
+                report['result'] = function(*operation.get('args', ()),
+                                            **operation.get('kwargs', {}))
+                report['ok'] = True
+            except Exception as e:
+                log.warning('Operation {} failed: {}'.format(report['key'], e))
+                report['error'] = '{}: {}'.format(type(e).__name__, e)
+            report['elapsed'] = time.time() - start
+            return report
+
+        for _, report in self.bulk(run, pending(), workers):
+            yield report
+
+    def then(self, result, function, *args):
+        """Return function applied to the result of a request.
+
+        The API functions pass their results on through here, so they also
+        work for the asyncio client, where result is awaitable.
+        """
+        return function(result, *args)
+
+    def new_id(self, result, message):
+        """Return the ID of a created object, logged with message."""
+        NewID = result.get('id')
+        log.info(message.format(NewID))
+        return NewID
 
     # From now on, Functions that work that way in all API Versions.
 
@@ -271,6 +2994,10 @@ class TpmApi(object):
         log.debug('Show project info: {}'.format(ID))
         return self.get('projects/{}.json'.format(ID))
 
+    def show_projects(self, IDs, workers=None):
+        """Show projects concurrently, yields (ID, project) pairs."""
+        return self.bulk(self.show_project, IDs, workers)
+
     def list_passwords_of_project(self, ID):
         """List passwords of project."""
         # http://teampasswordmanager.com/docs/api-projects/#list_pwds_prj
@@ -287,46 +3014,45 @@ class TpmApi(object):
         """Create a project."""
         # http://teampasswordmanager.com/docs/api-projects/#create_project
         log.info('Create project: {}'.format(data))
-        NewID = self.post('projects.json', data).get('id')
-        log.info('Project has been created with ID {}'.format(NewID))
-        return NewID
+        return self.then(self.post('projects.json', data), self.new_id,
+                         'Project has been created with ID {}')
 
     def update_project(self, ID, data):
         """Update a project."""
         # http://teampasswordmanager.com/docs/api-projects/#update_project
         log.info('Update project {} with {}'.format(ID, data))
-        self.put('projects/{}.json'.format(ID), data)
+        return self.put('projects/{}.json'.format(ID), data)
 
     def change_parent_of_project(self, ID, NewParentID):
         """Change parent of project."""
         # http://teampasswordmanager.com/docs/api-projects/#change_parent
         log.info('Change parrent for project {} to {}'.format(ID, NewParentID))
         data = {'parent_id': NewParentID}
-        self.put('projects/{}/change_parent.json'.format(ID), data)
+        return self.put('projects/{}/change_parent.json'.format(ID), data)
 
     def update_security_of_project(self, ID, data):
         """Update security of project."""
         # http://teampasswordmanager.com/docs/api-projects/#update_project_security
         log.info('Update project {} security {}'.format(ID, data))
-        self.put('projects/{}/security.json'.format(ID), data)
+        return self.put('projects/{}/security.json'.format(ID), data)
 
     def archive_project(self, ID):
         """Archive a project."""
         # http://teampasswordmanager.com/docs/api-projects/#arch_unarch_project
         log.info('Archive project {}'.format(ID))
-        self.put('projects/{}/archive.json'.format(ID))
+        return self.put('projects/{}/archive.json'.format(ID))
 
     def unarchive_project(self, ID):
         """Un-Archive a project."""
         # http://teampasswordmanager.com/docs/api-projects/#arch_unarch_project
         log.info('Unarchive project {}'.format(ID))
-        self.put('projects/{}/unarchive.json'.format(ID))
+        return self.put('projects/{}/unarchive.json'.format(ID))
 
     def delete_project(self, ID):
         """Delete a project."""
         # http://teampasswordmanager.com/docs/api-projects/#delete_project
         log.info('Delete project {}'.format(ID))
-        self.delete('projects/{}.json'.format(ID))
+        return self.delete('projects/{}.json'.format(ID))
 
     # http://teampasswordmanager.com/docs/api-passwords/#list_passwords
     def list_passwords(self):
@@ -355,6 +3081,10 @@ class TpmApi(object):
         log.info('Show password info: {}'.format(ID))
         return self.get('passwords/{}.json'.format(ID))
 
+    def show_passwords(self, IDs, workers=None):
+        """Show passwords concurrently, yields (ID, password) pairs."""
+        return self.bulk(self.show_password, IDs, workers)
+
     def list_user_access_on_password(self, ID):
         """List users who can access a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#list_users_pwd
@@ -365,46 +3095,44 @@ class TpmApi(object):
         """Create a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#create_password
         log.info('Create new password {}'.format(data))
-        NewID = self.post('passwords.json', data).get('id')
-        log.info('Password has been created with ID {}'.format(NewID))
-        return NewID
+        return self.then(self.post('passwords.json', data), self.new_id,
+                         'Password has been created with ID {}')
 
     def update_password(self, ID, data):
         """Update a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#update_password
         log.info('Update Password {} with {}'.format(ID, data))
-        self.put('passwords/{}.json'.format(ID), data)
+        return self.put('passwords/{}.json'.format(ID), data)
 
     def update_security_of_password(self, ID, data):
         """Update security of a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#update_security_password
         log.info('Update security of password {} with {}'.format(ID, data))
-        self.put('passwords/{}/security.json'.format(ID), data)
+        return self.put('passwords/{}/security.json'.format(ID), data)
 
     def update_custom_fields_of_password(self, ID, data):
         """Update custom fields definitions of a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#update_cf_password
         log.info('Update custom fields of password {} with {}'.format(ID, data))
-        self.put('passwords/{}/custom_fields.json'.format(ID), data)
+        return self.put('passwords/{}/custom_fields.json'.format(ID), data)
 
     def delete_password(self, ID):
         """Delete a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#delete_password
         log.info('Delete password {}'.format(ID))
-        self.delete('passwords/{}.json'.format(ID))
+        return self.delete('passwords/{}.json'.format(ID))
 
     def lock_password(self, ID):
         """Lock a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#lock_password
         log.info('Lock password {}'.format(ID))
-        self.put('passwords/{}/lock.json'.format(ID))
+        return self.put('passwords/{}/lock.json'.format(ID))
 
     def unlock_password(self, ID, reason):
         """Unlock a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#unlock_password
         log.info('Unlock password {}, Reason: {}'.format(ID, reason))
-        self.unlock_reason = reason
-        self.put('passwords/{}/unlock.json'.format(ID))
+        return self.put('passwords/{}/unlock.json'.format(ID), unlock_reason=reason)
 
     def list_mypasswords(self):
         """List my passwords."""
@@ -424,49 +3152,52 @@ class TpmApi(object):
         log.debug('Show MyPassword {}'.format(ID))
         return self.get('my_passwords/{}.json'.format(ID))
 
+    def show_mypasswords(self, IDs, workers=None):
+        """Show my passwords concurrently, yields (ID, password) pairs."""
+        return self.bulk(self.show_mypassword, IDs, workers)
+
     def create_mypassword(self, data):
         """Create my password."""
         # http://teampasswordmanager.com/docs/api-my-passwords/#create_password
         log.info('Create MyPassword with {}'.format(data))
-        NewID = self.post('my_passwords.json', data).get('id')
-        log.info('MyPassword has been created with {}'.format(NewID))
-        return NewID
+        return self.then(self.post('my_passwords.json', data), self.new_id,
+                         'MyPassword has been created with {}')
 
     def update_mypassword(self, ID, data):
         """Update my password."""
         # http://teampasswordmanager.com/docs/api-my-passwords/#update_password
         log.info('Update MyPassword {} with {}'.format(ID, data))
-        self.put('my_passwords/{}.json'.format(ID), data)
+        return self.put('my_passwords/{}.json'.format(ID), data)
 
     def delete_mypassword(self, ID):
         """Delete my password."""
         # http://teampasswordmanager.com/docs/api-my-passwords/#delete_password
         log.info('Delete password {}'.format(ID))
-        self.delete('my_passwords/{}.json'.format(ID))
+        return self.delete('my_passwords/{}.json'.format(ID))
 
     def set_favorite_password(self, ID):
         """Set a password as favorite."""
         # http://teampasswordmanager.com/docs/api-favorites/#set_fav
         log.info('Set password {} as favorite'.format(ID))
-        self.post('favorite_passwords/{}.json'.format(ID))
+        return self.post('favorite_passwords/{}.json'.format(ID))
 
     def unset_favorite_password(self, ID):
         """Unet a password as favorite."""
         # http://teampasswordmanager.com/docs/api-favorites/#del_fav
         log.info('Unset password {} as favorite'.format(ID))
-        self.delete('favorite_passwords/{}.json'.format(ID))
+        return self.delete('favorite_passwords/{}.json'.format(ID))
 
     def set_favorite_project(self, ID):
         """Set a project as favorite."""
         # http://teampasswordmanager.com/docs/api-favorites/#set_fav
         log.info('Set project {} as favorite'.format(ID))
-        self.post('favorite_project/{}.json'.format(ID))
+        return self.post('favorite_project/{}.json'.format(ID))
 
     def unset_favorite_project(self, ID):
         """Unet a project as favorite."""
         # http://teampasswordmanager.com/docs/api-favorites/#del_fav
         log.info('Unset project {} as favorite'.format(ID))
-        self.delete('favorite_project/{}.json'.format(ID))
+        return self.delete('favorite_project/{}.json'.format(ID))
 
     def list_users(self):
         """List users."""
@@ -480,6 +3211,10 @@ class TpmApi(object):
         log.debug('Show user {}'.format(ID))
         return self.get('users/{}.json'.format(ID))
 
+    def show_users(self, IDs, workers=None):
+        """Show users concurrently, yields (ID, user) pairs."""
+        return self.bulk(self.show_user, IDs, workers)
+
     def show_me(self):
         """Show me."""
         # http://teampasswordmanager.com/docs/api-users/#show_me
@@ -494,51 +3229,50 @@ class TpmApi(object):
         """Create a User."""
         # http://teampasswordmanager.com/docs/api-users/#create_user
         log.info('Create user with {}'.format(data))
-        NewID = self.post('users.json', data).get('id')
-        log.info('User has been created with ID {}'.format(NewID))
-        return NewID
+        return self.then(self.post('users.json', data), self.new_id,
+                         'User has been created with ID {}')
 
     def update_user(self, ID, data):
         """Update a User."""
         # http://teampasswordmanager.com/docs/api-users/#update_user
         log.info('Update user {} with {}'.format(ID, data))
-        self.put('users/{}.json'.format(ID), data)
+        return self.put('users/{}.json'.format(ID), data)
 
     def change_user_password(self, ID, data):
         """Change password of a User."""
         # http://teampasswordmanager.com/docs/api-users/#change_password
         log.info('Change user {} password'.format(ID))
-        self.put('users/{}/change_password.json'.format(ID), data)
+        return self.put('users/{}/change_password.json'.format(ID), data)
 
     def activate_user(self, ID):
         """Activate a User."""
         # http://teampasswordmanager.com/docs/api-users/#activate_deactivate
         log.info('Activate user {}'.format(ID))
-        self.put('users/{}/activate.json'.format(ID))
+        return self.put('users/{}/activate.json'.format(ID))
 
     def deactivate_user(self, ID):
         """Dectivate a User."""
         # http://teampasswordmanager.com/docs/api-users/#activate_deactivate
         log.info('Deactivate user {}'.format(ID))
-        self.put('users/{}/deactivate.json'.format(ID))
+        return self.put('users/{}/deactivate.json'.format(ID))
 
     def convert_user_to_ldap(self, ID, DN):
         """Convert a normal user to a LDAP user."""
         # http://teampasswordmanager.com/docs/api-users/#convert_to_ldap
         data = {'login_dn': DN}
         log.info('Convert User {} to LDAP DN {}'.format(ID, DN))
-        self.put('users/{}/convert_to_ldap.json'.format(ID), data)
+        return self.put('users/{}/convert_to_ldap.json'.format(ID), data)
 
     def convert_ldap_user_to_normal(self, ID):
         """Convert a LDAP user to a normal user."""
         log.info('Convert User {} from LDAP to normal user'.format(ID))
-        self.put('users/{}/convert_to_normal.json'.format(ID))
+        return self.put('users/{}/convert_to_normal.json'.format(ID))
 
     def delete_user(self, ID):
         """Delete a user."""
         # http://teampasswordmanager.com/docs/api-users/#delete_user
         log.info('Delete user {}'.format(ID))
-        self.delete('users/{}.json'.format(ID))
+        return self.delete('users/{}.json'.format(ID))
 
     def list_groups(self):
         """List Groups."""
@@ -552,37 +3286,40 @@ class TpmApi(object):
         log.debug('Show group {}'.format(ID))
         return self.get('groups/{}.json'.format(ID))
 
+    def show_groups(self, IDs, workers=None):
+        """Show groups concurrently, yields (ID, group) pairs."""
+        return self.bulk(self.show_group, IDs, workers)
+
     def create_group(self, data):
         """Create a Group."""
         # http://teampasswordmanager.com/docs/api-groups/#create_group
         log.info('Create group with {}'.format(data))
-        NewID = self.post('groups.json', data).get('id')
-        log.info('Group has been created with ID {}'.format(NewID))
-        return NewID
+        return self.then(self.post('groups.json', data), self.new_id,
+                         'Group has been created with ID {}')
 
     def update_group(self, ID, data):
         """Update a Group."""
         # http://teampasswordmanager.com/docs/api-groups/#update_group
         log.info('Update group {} with {}'.format(ID, data))
-        self.put('groups/{}.json'.format(ID), data)
+        return self.put('groups/{}.json'.format(ID), data)
 
     def add_user_to_group(self, GroupID, UserID):
         """Add a user to a group."""
         # http://teampasswordmanager.com/docs/api-groups/#add_user
         log.info('Add User {} to Group {}'.format(UserID, GroupID))
-        self.put('groups/{}/add_user/{}.json'.format(GroupID, UserID))
+        return self.put('groups/{}/add_user/{}.json'.format(GroupID, UserID))
 
     def delete_user_from_group(self, GroupID, UserID):
         """Delete a user from a group."""
         # http://teampasswordmanager.com/docs/api-groups/#del_user
         log.info('Delete user {} from group {}'.format(UserID, GroupID))
-        self.put('groups/{}/delete_user/{}.json'.format(GroupID, UserID))
+        return self.put('groups/{}/delete_user/{}.json'.format(GroupID, UserID))
 
     def delete_group(self, ID):
         """Delete a group."""
         # http://teampasswordmanager.com/docs/api-groups/#delete_group
         log.info('Delete group {}'.format(ID))
-        self.delete('groups/{}.json'.format(ID))
+        return self.delete('groups/{}.json'.format(ID))
 
     def generate_password(self):
         """Generate a new random password."""
@@ -604,17 +3341,19 @@ class TpmApi(object):
 
     def up_to_date(self):
         """Check if Team Password Manager is up to date."""
-        VersionInfo = self.get_latest_version()
-        CurrentVersion = VersionInfo.get('version')
-        LatestVersion = VersionInfo.get('latest_version')
-        if  CurrentVersion == LatestVersion:
-            log.info('TeamPasswordManager is up-to-date!')
-            log.debug('Current Version: {} Latest Version: {}'.format(LatestVersion, LatestVersion))
-            return True
-        else:
-            log.warning('TeamPasswordManager is not up-to-date!')
-            log.debug('Current Version: {} Latest Version: {}'.format(LatestVersion, LatestVersion))
-            return False
+        def compare(VersionInfo):
+            CurrentVersion = VersionInfo.get('version')
+            LatestVersion = VersionInfo.get('latest_version')
+            if  CurrentVersion == LatestVersion:
+                log.info('TeamPasswordManager is up-to-date!')
+                log.debug('Current Version: {} Latest Version: {}'.format(LatestVersion, LatestVersion))
+                return True
+            else:
+                log.warning('TeamPasswordManager is not up-to-date!')
+                log.debug('Current Version: {} Latest Version: {}'.format(LatestVersion, LatestVersion))
+                return False
+
+        return self.then(self.get_latest_version(), compare)
 
 
 class TpmApiv3(TpmApi):
@@ -661,9 +3400,8 @@ class TpmApiv5(TpmApiv4):
             }
             if 'notes' in kwargs:
                 data['notes'] = kwargs['notes']
-            NewID = self.post('projects/{}/upload.json'.format(ID), data).get('id')
-            log.info('File has been uploaded with ID {}'.format(NewID))
-            return NewID
+            return self.then(self.post('projects/{}/upload.json'.format(ID), data), self.new_id,
+                             'File has been uploaded with ID {}')
         else:
             raise Exception("File not found: {}".format(file))
 
@@ -671,19 +3409,19 @@ class TpmApiv5(TpmApiv4):
         """Archive a password."""
         # http://teampasswordmanager.com/docs/api-passwords/#arch_unarch_password
         log.info('Archive password {}'.format(ID))
-        self.put('passwords/{}/archive.json'.format(ID))
+        return self.put('passwords/{}/archive.json'.format(ID))
 
     def unarchive_password(self, ID):
         """Un-Archive a project."""
         # http://teampasswordmanager.com/docs/api-passwords/#arch_unarch_password
         log.info('Unarchive password {}'.format(ID))
-        self.put('passwords/{}/unarchive.json'.format(ID))
+        return self.put('passwords/{}/unarchive.json'.format(ID))
 
     def move_password(self, ID, PROJECT_ID):
         """Move a password to another project."""
         # http://teampasswordmanager.com/docs/api-passwords/#move_password
         log.info('Move password {} to Project {}'.format(ID, PROJECT_ID))
-        self.put('passwords/{}/move.json'.format(ID), data={ "project_id": PROJECT_ID })
+        return self.put('passwords/{}/move.json'.format(ID), data={ "project_id": PROJECT_ID })
 
     def list_password_files(self, ID):
         """List files of a password."""
@@ -701,9 +3439,8 @@ class TpmApiv5(TpmApiv4):
             }
             if 'notes' in kwargs:
                 data['notes'] = kwargs['notes']
-            NewID = self.post('passwords/{}/upload.json'.format(ID), data).get('id')
-            log.info('File has been uploaded with ID {}'.format(NewID))
-            return NewID
+            return self.then(self.post('passwords/{}/upload.json'.format(ID), data), self.new_id,
+                             'File has been uploaded with ID {}')
         else:
             raise Exception("File not found: {}".format(file))
 
@@ -711,7 +3448,8 @@ class TpmApiv5(TpmApiv4):
         """Move a mypassword to another project."""
         # https://teampasswordmanager.com/docs/api-my-passwords/#move_password
         log.info('Move my_password {} to Project {}'.format(ID, PROJECT_ID))
-        return self.put('my_passwords/{}/move.json'.format(ID), data={ "project_id": PROJECT_ID }).get('id')
+        return self.then(self.put('my_passwords/{}/move.json'.format(ID), data={ "project_id": PROJECT_ID }),
+                         dict.get, 'id')
 
     def show_file_info(self, ID):
         """Show info of a file."""
@@ -719,11 +3457,15 @@ class TpmApiv5(TpmApiv4):
         log.info('Show info of file with ID: {}'.format(ID))
         return self.get('files/{}.json'.format(ID))
 
+    def show_files_info(self, IDs, workers=None):
+        """Show info of files concurrently, yields (ID, info) pairs."""
+        return self.bulk(self.show_file_info, IDs, workers)
+
     def update_file_notes(self, ID, NOTES):
         """Update the notes on a file."""
         # https://teampasswordmanager.com/docs/api-files/#update_file
         log.info('Update notes on file {} to: {}'.format(ID, NOTES))
-        self.put('files/{}.json'.format(ID), data={ "notes": NOTES })
+        return self.put('files/{}.json'.format(ID), data={ "notes": NOTES })
 
     def max_upload_file_size(self):
         """Show max upload file size."""
@@ -737,43 +3479,300 @@ class TpmApiv5(TpmApiv4):
         log.info('Show uploads_folder_info')
         return self.get('files/uploads_folder_info.json')
 
-    def download_file(self, ID):
-        """Get the content of a file."""
+    def download_file(self, ID, file=None):
+        """Get the content of a file.
+
+        If file is given, a path or a binary file object, the content is
+        written to it while it is received and the number of bytes written
+        is returned.
+        """
         # https://teampasswordmanager.com/docs/api-files/#download_file
         log.info('Download file with ID: {}'.format(ID))
-        return self.get('files/download/{}.json'.format(ID))
+        path = 'files/download/{}.json'.format(ID)
+        if file is None:
+            return self.get(path)
+        _, response = self.send_request(path, 'get', stream=True)
+        self.req = response
+        size = 0
+        with contextlib.ExitStack() as stack:
+            stack.callback(response.close)
+            if isinstance(file, str):
+                file = stack.enter_context(open(file, 'wb'))
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                file.write(chunk)
+                size += len(chunk)
+        log.info('Downloaded {} bytes of file {}'.format(size, ID))
+        return size
 
     def delete_file(self, ID):
         """Delete a file."""
         # https://teampasswordmanager.com/docs/api-files/#delete_file
         log.info('Delete file {}'.format(ID))
-        self.delete('files/{}.json'.format(ID))
+        return self.delete('files/{}.json'.format(ID))
 
     def create_user_ldap(self, data):
         """Create a LDAP User."""
         # http://teampasswordmanager.com/docs/api-users/#create_user_ldap
         log.info('Create LDAP user with {}'.format(data))
-        NewID = self.post('users_ldap.json', data).get('id')
-        log.info('LDAP User has been created with ID {}'.format(NewID))
-        return NewID
+        return self.then(self.post('users_ldap.json', data), self.new_id,
+                         'LDAP User has been created with ID {}')
 
     def create_user_saml(self, data):
         """Create a SAML User."""
         # http://teampasswordmanager.com/docs/api-users/#create_user_saml
         log.info('Create SAML user with {}'.format(data))
-        NewID = self.post('users_saml.json', data).get('id')
-        log.info('SAML User has been created with ID {}'.format(NewID))
-        return NewID
+        return self.then(self.post('users_saml.json', data), self.new_id,
+                         'SAML User has been created with ID {}')
 
     def convert_user_to_ldap(self, ID, DN, SERVER_ID):
         """Convert a normal user to a LDAP user."""
         # http://teampasswordmanager.com/docs/api-users/#convert_to_ldap
         data = {'login_dn': DN, "ldap_server_id": SERVER_ID}
         log.info('Convert User {} to LDAP DN {} at Server {}'.format(ID, DN, SERVER_ID))
-        self.put('users/{}/convert_to_ldap.json'.format(ID), data)
+        return self.put('users/{}/convert_to_ldap.json'.format(ID), data)
 
     def convert_user_to_saml(self, ID):
         """Convert a normal user to a SAML user."""
         # http://teampasswordmanager.com/docs/api-users/#convert_to_saml
         log.info('Convert User {} to SAML'.format(ID))
-        self.put('users/{}/convert_to_saml.json'.format(ID))
+        return self.put('users/{}/convert_to_saml.json'.format(ID))
+
+
+def as_coroutine(function):
+    """Return a coroutine function running an API function of TpmApi."""
+    @functools.wraps(function)
+    async def call(self, *args, **kwargs):
+        result = function(self, *args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+    return call
+
+
+def sync_only(name):
+    """Return a function that rejects a helper of TpmApi by name."""
+    def call(self, *args, **kwargs):
+        raise TypeError('{} is not supported by {}'.format(
+            name, type(self).__name__))
+    call.__name__ = name
+    call.__doc__ = 'Not supported by the asyncio client.'
+    return call
+
+
+class AsyncTpmApi(TpmApi):
+    """Settings needed for the asyncio connection to Team Password Manager.
+
+    Requires aiohttp. The API functions of TpmApi are shared, here they are
+    coroutines and get_collection is an async generator. Options and helpers
+    of TpmApi that rely on threads are rejected.
+    """
+    asynchronous = True
+    # options of TpmApi the asyncio client can not honour
+    unsupported = ('prefetch', 'page_workers', 'bulk_workers', 'concurrency',
+                   'hedging', 'cache', 'coalesce', 'stream', 'chunk_size',
+                   'lazy', 'records', 'dedupe')
+    # helpers of TpmApi used as they are
+    helpers = ('get_session', 'normalize_path', 'prepare_request',
+               'parse_response', 'record', 'throttled', 'current_deadline',
+               'timeout', 'check_circuit', 'latency_key', 'abandon',
+               'observe', 'next_page', 'page_path', 'count_path', 'to_record',
+               'new_id')
+    # helpers of TpmApi that raise TypeError
+    sync_only = ('deadline', 'bind_deadline', 'transmit', 'transmit_hedged',
+                 'send_request', 'add_listener', 'remove_listener', 'notify',
+                 'coalesced', 'decode_again', 'get_pages_streamed',
+                 'stream_items', 'get_pages_parallel', 'bulk', 'run_batch',
+                 'show_projects', 'show_passwords', 'show_mypasswords',
+                 'show_users', 'show_groups', 'show_files_info')
+
+    def __init_subclass__(cls, **kwargs):
+        """Share the API functions of the TpmApi class of a version."""
+        super(AsyncTpmApi, cls).__init_subclass__(**kwargs)
+        for name in dir(cls):
+            function = getattr(cls, name)
+            if name.startswith('_') or not inspect.isfunction(function) or\
+                    name in cls.helpers or\
+                    any(name in vars(klass) for klass in cls.__mro__
+                        if issubclass(klass, AsyncTpmApi)):
+                continue
+            if name in cls.sync_only:
+                setattr(cls, name, sync_only(name))
+            else:
+                setattr(cls, name, as_coroutine(function))
+
+    def __init__(self, api, base_url, kwargs):
+        """init thing."""
+        if aiohttp is None:
+            raise self.ConfigError('aiohttp is required for the asyncio client')
+        unsupported = [key for key in self.unsupported if kwargs.get(key)]
+        if unsupported:
+            raise self.ConfigError('Not supported by the asyncio client: '
+                                   + ', '.join(unsupported))
+        # the next class of a version is a TpmApi too, with another signature
+        TpmApi.__init__(self, api, base_url, kwargs)
+
+    def __enter__(self):
+        raise TypeError('Use "async with" for {}'.format(type(self).__name__))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def get_session(self):
+        """Return the pooled aiohttp session, (re)creating it if needed."""
+        if self.session is None or self.session.closed:
+            log.debug('Create session with pool size {}/{}'.format(
+                self.pool_connections, self.pool_maxsize))
+            options = {'limit': self.pool_connections * self.pool_maxsize,
+                       'limit_per_host': self.pool_maxsize,
+                       'ssl': False}
+            if not self.keep_alive:
+                options['force_close'] = True
+            elif self.max_idle:
+                options['keepalive_timeout'] = self.max_idle
+            timeout = aiohttp.ClientTimeout(total=None,
+                                            sock_connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**options), timeout=timeout)
+        return self.session
+
+    async def close(self):
+        """Close all pooled connections."""
+        if self.session is not None:
+            log.debug('Close session.')
+            await self.session.close()
+            self.session = None
+
+    async def backoff(self, action, url, attempt, reason, retry_after=None):
+        """Log, count and wait before a retry."""
+        delay = self.retry.delay(attempt, retry_after)
+        log.warning('Retry {} {} in {:.2f}s ({}/{}): {}'.format(
+            action.upper(), url, delay, attempt + 1, self.retry.retries, reason))
+        self.record('retries')
+        self.record('retries_' + action)
+        await asyncio.sleep(delay)
+
+    async def send(self, path, action, data='', unlock_reason=None):
+        """Make a request to the API, return the result and the response."""
+        attempt = 0
+        key = self.latency_key(action, path)
+        while True:
+            # sign again for every attempt, the timestamp is part of the hash
+            url, body, headers, credentials = self.prepare_request(
+                path, data, unlock_reason)
+            if credentials:
+                token = base64.b64encode(':'.join(credentials).encode('utf-8'))
+                headers['Authorization'] = 'Basic ' + token.decode('ascii')
+            session = self.get_session()
+            self.check_circuit(url)
+            start = time.monotonic()
+            # Try API request and handle Exceptions
+            try:
+                if self.rate_limiter is not None:
+                    delay = self.rate_limiter.reserve(action)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    self.throttled(delay)
+                self.record('requests')
+                log.debug('{} request {}'.format(action.upper(), url))
+                start = time.monotonic()
+                async with session.request(action.upper(), url,
+                                           headers=headers,
+                                           data=body or None) as response:
+                    content = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.observe(start, True)
+                if self.retry.allowed(action, attempt):
+                    await self.backoff(action, url, attempt, e)
+                    attempt += 1
+                    continue
+                self.record('errors')
+                log.critical("Connection error for " + str(e))
+                raise TPMException("Connection error for " + str(e))
+            except aiohttp.ClientError as e:
+                self.observe(start, True)
+                self.record('errors')
+                log.critical("Connection error for " + str(e))
+                raise TPMException("Connection error for " + str(e))
+            except BaseException:
+                # e.g. a cancelled task, it must not keep a probe slot
+                self.abandon()
+                raise
+            self.observe(start, response.status >= 500 or
+                         response.status == 429, key)
+            if response.status in self.retry.statuses and\
+                    self.retry.allowed(action, attempt):
+                await self.backoff(action, url, attempt, response.status,
+                                   response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+            break
+        result = self.parse_response(url, response.status, content,
+                                     str(response.url))
+        return result, response
+
+    async def request(self, path, action, data='', unlock_reason=None):
+        """To make a request to the API."""
+        result, self.req = await self.send(path, action, data, unlock_reason)
+        return result
+
+    async def post(self, path, data=''):
+        """For post based requests."""
+        return await self.request(path, 'post', data)
+
+    async def get(self, path):
+        """For get based requests."""
+        return await self.request(path, 'get')
+
+    async def put(self, path, data='', unlock_reason=None):
+        """For put based requests."""
+        return await self.request(path, 'put', data, unlock_reason)
+
+    async def delete(self, path):
+        """For delete based requests."""
+        await self.request(path, 'delete')
+
+    async def get_pages(self, path):
+        """To get all pages of a collection, one list of items per page."""
+        while path:
+            items, response = await self.send(path, 'get')
+            yield items
+            path = self.next_page(response)
+
+    async def get_collection(self, path):
+        """To get pagewise data."""
+        async for items in self.get_pages(path):
+            for item in items:
+                yield item
+
+    async def collection(self, path):
+        """To return all items generated by get collection."""
+        data = []
+        async for item in self.get_collection(path):
+            data.append(item)
+        return data
+
+    async def then(self, result, function, *args):
+        """Return function applied to the result of a request, once done."""
+        return function(await result, *args)
+
+
+class AsyncTpmApiv3(AsyncTpmApi, TpmApiv3):
+    """API v3 based asyncio class."""
+    def __init__(self, url, **kwargs):
+        super(AsyncTpmApiv3, self).__init__('v3', url, kwargs)
+
+
+class AsyncTpmApiv4(AsyncTpmApi, TpmApiv4):
+    """API v4 based asyncio class."""
+    def __init__(self, url, **kwargs):
+        super(AsyncTpmApiv4, self).__init__('v4', url, kwargs)
+
+
+class AsyncTpmApiv5(AsyncTpmApi, TpmApiv5):
+    """API v5 based asyncio class."""
+    def __init__(self, url, **kwargs):
+        super(AsyncTpmApiv5, self).__init__('v5', url, kwargs)